@@ -15,6 +15,15 @@ def init_parser(parser):
     parser.add_argument('--safe-length-collision', type=int, default=5)
     parser.add_argument('--safe-length-offroad', type=int, default=5)
     parser.add_argument('--bin-divide', type=list, default=[5, 5])
+    parser.add_argument('--planner', type=str, default='sample', choices=['sample', 'cem'], help='one round of num-candidates samples, or the cross-entropy method')
+    parser.add_argument('--num-candidates', type=int, default=25, help='action sequences scored per planning step by the sample planner')
+    parser.add_argument('--cem-population', type=int, default=25)
+    parser.add_argument('--cem-elites', type=int, default=5)
+    parser.add_argument('--cem-iters', type=int, default=3)
+    parser.add_argument('--cem-time-budget', type=float, default=0.0, help='seconds per planning step before CEM stops refining (0 disables)')
+    parser.add_argument('--warm-start', action='store_true', help='replace some candidates with the shifted previous plan and perturbations of it')
+    parser.add_argument('--warm-start-perturbations', type=int, default=4)
+    parser.add_argument('--warm-start-noise', type=float, default=0.1)
 
     parser.add_argument('--lr', type=float, default=1e-3, metavar='LR', help='learning rate')
     parser.add_argument('--frame-history-len', type=int, default=3)
@@ -23,6 +32,25 @@ def init_parser(parser):
     parser.add_argument('--save-freq', type=int, default=100)
     parser.add_argument('--save-path', type=str, default='spc')
     parser.add_argument('--buffer-size', type=int, default=20000)
+    parser.add_argument('--buffer-chunk-size', type=int, default=0, help='grow in-memory replay fields in chunks of this many frames; slower gathers (0 allocates buffer-size at once)')
+    parser.add_argument('--buffer-stats-freq', type=int, default=10, help='log replay buffer statistics every this many episodes (0 disables)')
+    parser.add_argument('--shared-block-size', type=int, default=256, help='slots a writer reserves at a time in a shared replay buffer')
+    parser.add_argument('--memmap-buffer', action='store_true', help='keep the replay buffer in memory-mapped files under save-path')
+    parser.add_argument('--pack-seg', action='store_true', help='store segmentation labels with 2 or 4 bits per pixel')
+    parser.add_argument('--episodic-buffer', action='store_true', help='evict whole episodes from the replay buffer instead of overwriting frame by frame')
+    parser.add_argument('--pin-expert-laps', type=int, default=0, help='extra buffer laps an expert episode survives with --episodic-buffer')
+    parser.add_argument('--prioritized-replay', action='store_true', help='sample training windows from a sum-tree by prediction loss')
+    parser.add_argument('--priority-alpha', type=float, default=0.6)
+    parser.add_argument('--priority-beta', type=float, default=0.4)
+    parser.add_argument('--priority-eps', type=float, default=1e-3)
+    parser.add_argument('--priority-event-bonus', type=float, default=1.0, help='extra initial priority of windows with a collision or off-road event')
+    parser.add_argument('--obs-codec', type=str, default='raw', choices=['raw', 'png', 'webp', 'jpeg'], help='image codec for observations in the replay buffer')
+    parser.add_argument('--obs-quality', type=int, default=95, help='JPEG quality for --obs-codec jpeg')
+    parser.add_argument('--obs-decode-workers', type=int, default=4)
+    parser.add_argument('--replay-address', type=str, default='', help='use the replay server at host:port or unix:path instead of a local buffer (loopback starts one in-process)')
+    parser.add_argument('--replay-store-batch', type=int, default=32, help='frames sent per bulk insert to a replay server')
+    parser.add_argument('--export-episodes', type=str, default='', help='write every finished episode to this directory as npy columns')
+    parser.add_argument('--offline', type=str, default='', help='train from episodes exported to this directory instead of a simulator')
     parser.add_argument('--num-total-act', type=int, default=2)
     parser.add_argument('--epsilon-frames', type=int, default=50000)
     parser.add_argument('--learning-freq', type=int, default=100)
@@ -31,6 +59,8 @@ def init_parser(parser):
     parser.add_argument('--data-parallel', action='store_true')
     parser.add_argument('--id', type=int, default=0)
     parser.add_argument('--num-train-steps', type=int, default=10)
+    parser.add_argument('--prefetch-batches', type=int, default=0, help='number of training batches sampled ahead on worker threads (0 disables)')
+    parser.add_argument('--prefetch-workers', type=int, default=2)
     parser.add_argument('--max-steps', type=int, default=4000000000)
     # enviroument configurations
     parser.add_argument('--env', type=str, default='torcs')
@@ -61,4 +91,10 @@ def post_processing(args):
     args.env = args.env.lower()
     args.save_path = '{0}_{1}_{2}'.format(args.save_path, args.env, args.pred_step)
     args.sync = 'torcs' in args.env or 'carla' in args.env
+    assert not (args.memmap_buffer and args.obs_codec != 'raw'), 'compressed observations cannot be memory-mapped'
+    assert args.cem_population >= 1 and args.cem_iters >= 1, 'CEM needs at least one candidate and one iteration'
+    assert 0 < args.cem_elites <= args.cem_population, 'CEM needs between 1 and cem-population elites'
+    population = args.cem_population if args.planner == 'cem' else args.num_candidates
+    assert population >= 1, 'the planner needs at least one candidate'
+    assert not args.warm_start or args.warm_start_perturbations + 1 < population, 'warm-start candidates must leave room for sampled ones'
     return args
@@ -0,0 +1,140 @@
+from __future__ import division, print_function
+import json
+import os
+import numpy as np
+from memory import SPCBuffer, ExpertIndex
+
+# per-frame columns of an exported episode
+COLUMNS = ['obs', 'seg', 'action', 'guide_action', 'done', 'collision', 'offroad', 'speed', 'expert']
+MANIFEST = 'manifest.json'
+
+
+def read_manifest(root):
+    path = os.path.join(root, MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+class EpisodeExporter(object):
+    """Writes every finished episode to `root/<episode>/<column>.npy` and lists it in `root/manifest.json`."""
+    def __init__(self, root, args):
+        self.root = root
+        if not os.path.isdir(root):
+            os.makedirs(root)
+        self.manifest = read_manifest(root) or {'frame_height': args.frame_height,
+                                                'frame_width': args.frame_width,
+                                                'num_total_act': args.num_total_act,
+                                                'classes': args.classes,
+                                                'episodes': []}
+        self.rows = []
+
+    def store_frame(self, obs, collision, offroad, speed, seg):
+        self.rows.append({'obs': obs.transpose(2, 0, 1), 'seg': seg, 'collision': int(collision),
+                          'offroad': int(offroad), 'speed': speed})
+
+    def store_action(self, guide_action, action, done):
+        self.rows[-1].update(guide_action=guide_action, action=action, done=int(done))
+
+    def finish(self, expert):
+        # complete rows only; the manifest is written last so readers never see a partial episode
+        rows = [row for row in self.rows if 'done' in row]
+        self.rows = []
+        if len(rows) == 0:
+            return
+        columns = {'obs': np.stack([row['obs'] for row in rows]).astype(np.uint8),
+                   'seg': np.stack([row['seg'] for row in rows]).astype(np.uint8),
+                   'action': np.stack([row['action'] for row in rows]).astype(np.float32),
+                   'guide_action': np.array([row['guide_action'] for row in rows], dtype=np.int32),
+                   'done': np.array([row['done'] for row in rows], dtype=np.int32),
+                   'collision': np.array([row['collision'] for row in rows], dtype=np.int32),
+                   'offroad': np.array([row['offroad'] for row in rows], dtype=np.int32),
+                   'speed': np.array([row['speed'] for row in rows], dtype=np.float32),
+                   'expert': np.broadcast_to(np.asarray(expert, dtype=np.float32), (len(rows),))}
+        name = 'episode_%07d' % len(self.manifest['episodes'])
+        episode_dir = os.path.join(self.root, name)
+        if not os.path.isdir(episode_dir):
+            os.makedirs(episode_dir)
+        for column in COLUMNS:
+            np.save(os.path.join(episode_dir, column + '.npy'), columns[column])
+        self.manifest['episodes'].append({'name': name, 'length': len(rows)})
+        manifest_path = os.path.join(self.root, MANIFEST)
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+
+class EpisodeColumn(object):
+    """Memory-mapped per-episode arrays addressed as one array of concatenated frames."""
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self.offsets = np.cumsum([0] + [len(array) for array in arrays])
+        self.shape = (int(self.offsets[-1]),) + arrays[0].shape[1:]
+        self.dtype = arrays[0].dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def take(self, indices, axis=0, out=None, mode='wrap'):
+        assert axis == 0
+        indices = np.asarray(indices)
+        if out is None:
+            out = np.empty(indices.shape + self.shape[1:], dtype=self.dtype)
+        flat = indices.reshape(-1)
+        episode = np.searchsorted(self.offsets, flat, side='right') - 1
+        rows = out.reshape((-1,) + self.shape[1:])
+        for e in np.unique(episode):
+            sel = episode == e
+            rows[sel] = self.arrays[e][flat[sel] - self.offsets[e]]
+        return out
+
+
+class OfflineBuffer(SPCBuffer):
+    """Read-only SPCBuffer over an exported episode dataset. Observations and segmentation stay
+    memory-mapped; sample, sample_guide and their numpy variants behave as for a live buffer."""
+    def __init__(self, args, root):
+        super(OfflineBuffer, self).__init__(args)
+        manifest = read_manifest(root)
+        assert manifest is not None and len(manifest['episodes']) > 0, 'no exported episodes under %s' % root
+        assert (manifest['frame_height'], manifest['frame_width']) == (args.frame_height, args.frame_width)
+        self.priority_tree = None  # uniform sampling only
+
+        columns = dict((column, []) for column in COLUMNS)
+        for episode in manifest['episodes']:
+            for column in COLUMNS:
+                columns[column].append(np.load(os.path.join(root, episode['name'], column + '.npy'), mmap_mode='r'))
+        self.obs = EpisodeColumn(columns['obs'])
+        self.seg = EpisodeColumn(columns['seg'])
+        # the small per-frame columns are read into RAM
+        for column in ['action', 'guide_action', 'done', 'collision', 'offroad', 'speed', 'expert']:
+            setattr(self, column, np.concatenate(columns[column]))
+
+        self.num_in_buffer = len(self.obs)
+        self.next_idx = self.last_idx = 0
+        self.epi_lens = [episode['length'] for episode in manifest['episodes']]
+        self.sorted_epi_lens = sorted(self.epi_lens)
+        self.expert_index = ExpertIndex(self.num_in_buffer)
+        self.expert_index.add(np.arange(self.num_in_buffer), self.expert)
+
+        # windows that stay inside one episode and contain no done flag before their last frame
+        window_len = args.frame_history_len + args.pred_step
+        self.valid_starts = []
+        for e, length in enumerate(self.epi_lens):
+            offset = self.obs.offsets[e]
+            done = np.flatnonzero(self.done[offset:offset + length])
+            last_done = np.full([length], -1, dtype=np.int64)
+            last_done[done] = done
+            run_len = np.arange(length) - np.maximum.accumulate(last_done)
+            self.valid_starts.append(offset + np.flatnonzero(run_len >= window_len) - args.pred_step)
+        self.valid_starts = np.concatenate(self.valid_starts).astype(np.int64)
+        self.num_valid = len(self.valid_starts)
+
+    def _take_seg(self, index):
+        return self._take(self.seg, index)  # exported unpacked
+
+    def store_frame(self, obs, collision, offroad, speed, seg):
+        raise TypeError('offline buffers are read-only')
+
+    def store_action(self, guide_action, action, done):
+        raise TypeError('offline buffers are read-only')
@@ -1,5 +1,5 @@
 from __future__ import division, print_function
-from manager import BufferManager, ActionSampleManager
+from manager import EvalBufferManager, ActionSampleManager
 from utils import generate_guide_grid, log_frame, record_screen, draw_from_pred, from_variable_to_numpy
 from models import init_models
 import os
@@ -47,7 +47,7 @@ def evaluate_policy(args, env):
     guides = generate_guide_grid(args.bin_divide)
     train_net, net, optimizer, epoch, exploration, num_steps = init_models(args)
 
-    buffer_manager = BufferManager(args)
+    buffer_manager = EvalBufferManager(args)
     action_manager = ActionSampleManager(args, guides)
     action_var = Variable(torch.from_numpy(np.array([-1.0, 0.0])).repeat(1, args.frame_history_len - 1, 1), requires_grad=False).float()
 
@@ -83,6 +83,7 @@ def evaluate_policy(args, env):
                                                             action_var=action_var,
                                                             exploration=exploration,
                                                             step=step,
+                                                            feature_cache=buffer_manager.feature_cache,
                                                             explore=False,
                                                             testing=True)
         draw(action, step, obs_var, net, args, action_var, 'outcome')
@@ -101,6 +102,8 @@ def evaluate_policy(args, env):
 
         if done:
             print('Episode finished ...')
+            buffer_manager.reset(step)
+            action_manager.reset()
             if args.recording:
                 if args.sync:
                     video.release()
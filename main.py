@@ -2,7 +2,7 @@ import argparse
 from args import init_parser, post_processing
 import numpy as np
 import torch
-from train import train_policy
+from train import train_policy, train_offline
 from evaluate import evaluate_policy
 from utils import setup_dirs
 import random
@@ -19,7 +19,10 @@ if __name__ == '__main__':
     np.random.seed(args.seed)
     random.seed(args.seed)
 
-    if 'carla8' in args.env:
+    if args.offline:
+        # train from recorded episodes, no simulator needed
+        train_offline(args, max_steps=args.max_steps)
+    elif 'carla8' in args.env:
         # run spc on carla0.9 simulator, currently only 0.9.4 is supported
         from envs.CARLA.carla.client import make_carla_client
         from envs.CARLA.carla8 import CarlaEnv
@@ -6,117 +6,262 @@ import torch
 from torch.autograd import Variable
 import torch.nn.functional as F
 from memory import SPCBuffer
+from replay_server import RemoteSPCBuffer, start_loopback
+from dataset import EpisodeExporter
 from utils import setup_logger, sample_action, get_guide_action
 
 
 class ObsBuffer:
+    """Rolling frame history kept in a preallocated ring on the planning device.
+
+    Each frame is written to slot p and p + frame_history_len, so the latest history is always the
+    contiguous slice [p + 1, p + 1 + frame_history_len) and store_frame returns a view of it. The view is
+    overwritten by the next call; copy it if it has to outlive the step.
+    """
     def __init__(self, frame_history_len=3):
         self.frame_history_len = frame_history_len
-        self.last_obs_all = []
+        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.buffer = None  # [2 * frame_history_len, 3, H, W] float
+        self.staging = None  # pinned host copy of the incoming HWC frame
+        self.upload = None  # device copy of the incoming HWC frame
+        self.num_frames = 0
+
+    def allocate(self, frame):
+        h, w, c = frame.shape
+        self.buffer = torch.zeros(2 * self.frame_history_len, c, h, w, device=self.device)
+        if self.device.type == 'cuda':
+            self.staging = torch.empty(h, w, c, dtype=torch.uint8).pin_memory()
+            self.upload = torch.empty(h, w, c, dtype=torch.uint8, device=self.device)
 
     def store_frame(self, frame):
-        obs_np = frame.transpose(2, 0, 1)
-        if len(self.last_obs_all) < self.frame_history_len:
-            self.last_obs_all = []
-            for ii in range(self.frame_history_len):
-                self.last_obs_all.append(obs_np)
+        if self.buffer is None:
+            self.allocate(frame)
+        p = self.num_frames % self.frame_history_len
+        if self.upload is not None:
+            self.staging.numpy()[...] = frame
+            self.upload.copy_(self.staging)
+            src = self.upload
         else:
-            self.last_obs_all = self.last_obs_all[1:] + [obs_np]
-        return np.concatenate(self.last_obs_all, 0)
+            src = torch.from_numpy(np.ascontiguousarray(frame))
+        self.buffer[p].copy_(src.permute(2, 0, 1))
+        if self.num_frames == 0:
+            self.buffer[1:].copy_(self.buffer[:1].expand_as(self.buffer[1:]))
+        else:
+            self.buffer[p + self.frame_history_len].copy_(self.buffer[p])
+        self.num_frames += 1
+        _, c, h, w = self.buffer.size()
+        return self.buffer[p + 1:p + 1 + self.frame_history_len].view(1, self.frame_history_len * c, h, w)
+
+    def frame_ids(self):
+        # sequence numbers of the frames in the current history; the first frame fills every slot
+        return [max(0, self.num_frames - self.frame_history_len + i) for i in range(self.frame_history_len)]
 
     def clear(self):
-        self.last_obs_all = []
+        self.num_frames = 0
         return
 
 
+class FeatureCache:
+    """Backbone encodings of the frames in the current history, keyed by frame sequence number,
+    so that the planner only encodes the newest frame. Clear it whenever the network weights change."""
+    def __init__(self):
+        self.frame_ids = []
+        self.entries = dict()
+
+    def set_frames(self, frame_ids):
+        self.frame_ids = frame_ids
+        for frame_id in list(self.entries):
+            if frame_id not in frame_ids:
+                del self.entries[frame_id]
+
+    def encode(self, net, imgs):
+        # imgs: [1, 3 * frame_history_len, H, W] scaled to [0, 1]
+        encodings = []
+        for i, frame_id in enumerate(self.frame_ids):
+            if frame_id not in self.entries:
+                self.entries[frame_id] = net.conv_lstm.dlaseg(imgs[:, i * 3:(i + 1) * 3, :, :])
+            encodings.append(self.entries[frame_id])
+        return encodings
+
+    def clear(self):
+        self.entries = dict()
+
+
 class ActionBuffer:
+    """Rolling action history kept in a preallocated ring, laid out like ObsBuffer."""
     def __init__(self, frame_history_len=3):
         self.frame_history_len = frame_history_len
-        self.last_action_all = []
+        self.buffer = None  # [2 * frame_history_len, num_act] float
+        self.num_frames = 0
 
     def store_frame(self, action):
-        action = action.reshape(1, -1)
-        if len(self.last_action_all) < self.frame_history_len:
-            self.last_action_all = []
-            for ii in range(self.frame_history_len):
-                self.last_action_all.append(action)
+        action = torch.from_numpy(np.asarray(action, dtype=np.float32).reshape(-1))
+        if self.buffer is None:
+            self.buffer = torch.zeros(2 * self.frame_history_len, action.size(0))
+        p = self.num_frames % self.frame_history_len
+        if self.num_frames == 0:
+            self.buffer.copy_(action.expand_as(self.buffer))
         else:
-            self.last_action_all = self.last_action_all[1:] + [action]
-        return np.concatenate(self.last_action_all, 0)[np.newaxis, ]
+            self.buffer[p].copy_(action)
+            self.buffer[p + self.frame_history_len].copy_(action)
+        self.num_frames += 1
+        return self.buffer[p + 1:p + 1 + self.frame_history_len].unsqueeze(0)
 
     def clear(self):
-        self.last_action_all = []
+        self.num_frames = 0
         return
 
 
-class BufferManager:
+class SafetyLabeller:
+    """Online safe-window labels: frame i is safe if no event happens in [i, i + safe_length)."""
+    def __init__(self, safe_length):
+        self.safe_length = safe_length
+        self.reset()
+
+    def reset(self):
+        self.num_frames = 0
+        self.last_event = -1
+        self.safe = []
+
+    def push(self, event):
+        if event:
+            self.last_event = self.num_frames
+        self.num_frames += 1
+        # the window starting safe_length - 1 frames ago is now complete
+        start = self.num_frames - self.safe_length
+        if start >= 0:
+            self.safe.append(self.last_event < start)
+
+    def finish(self):
+        # windows still open at episode end are truncated, so they only see events up to the last frame
+        tail = np.arange(len(self.safe), self.num_frames) > self.last_event
+        safe = np.concatenate([np.array(self.safe, dtype=bool), tail])
+        self.reset()
+        return safe
+
+
+class EvalBufferManager:
+    """Inference-only manager: rolling obs/action history and episode statistics, no replay storage."""
     def __init__(self, args=None):
         self.args = args
         mode = 'eval' if args.eval else 'train'
         self.logger = setup_logger(mode, os.path.join(args.save_path, 'log_{}_{}.txt'.format(mode, args.env)))
 
-        self.spc_buffer = SPCBuffer(args)
-        if args.resume:
-            self.spc_buffer.load(args.save_path)
         self.obs_buffer = ObsBuffer(args.frame_history_len)
         self.action_buffer = ActionBuffer(args.frame_history_len - 1)
+        self.feature_cache = FeatureCache()
         self.rewards = 0.0
         self.prev_act = np.array([1.0, 0.0])
 
         self.reward = 0.0
-        self.collision_buffer = []
-        self.offroad_buffer = []
-        self.idx_buffer = []
         self.dist_sum = 0.0
+        self.epi_len = 0
+        self.num_collisions = 0
+        self.num_offroad = 0
 
     def store_frame(self, obs, info):
-        past_n_frames = self.obs_buffer.store_frame(obs)
-        obs_var = Variable(torch.from_numpy(past_n_frames).unsqueeze(0).float().cuda())
+        obs_var = self.obs_buffer.store_frame(obs)
+        self.feature_cache.set_frames(self.obs_buffer.frame_ids())
+        self.dist_sum += info['speed']
+        self.epi_len += 1
+        return obs_var
 
+    def store_effect(self, guide_action, action, reward, done, collision, offroad):
+        self.prev_act = copy.deepcopy(action)
+        act_var = self.action_buffer.store_frame(action)
+        self.reward += reward
+        self.num_collisions += int(collision)
+        self.num_offroad += int(offroad)
+        return act_var
+
+    def log_episode(self, step):
+        self.logger.info('step {} reward {} length {} distance {:.2f} collisions {} offroad {}'.format(
+            step, self.reward, self.epi_len, self.dist_sum, self.num_collisions, self.num_offroad))
+
+    def clear(self):
+        self.obs_buffer.clear()
+        self.action_buffer.clear()
+        self.feature_cache.clear()
+        self.prev_act = np.array([1.0, 0.0])
+        self.dist_sum = 0.0
+        self.reward = 0.0
+        self.epi_len = 0
+        self.num_collisions = 0
+        self.num_offroad = 0
+
+    def reset(self, step):
+        self.log_episode(step)
+        self.clear()
+
+
+class BufferManager(EvalBufferManager):
+    def __init__(self, args=None):
+        super(BufferManager, self).__init__(args)
+        if args.replay_address == 'loopback':
+            self.replay_server, self.spc_buffer = start_loopback(args)
+        elif args.replay_address:
+            self.spc_buffer = RemoteSPCBuffer(args, args.replay_address)
+        else:
+            self.spc_buffer = SPCBuffer(args)
+            if args.resume:
+                self.spc_buffer.load(args.save_path)
+        self.exporter = EpisodeExporter(args.export_episodes, args) if args.export_episodes else None
+        self.collision_labeller = SafetyLabeller(args.safe_length_collision)
+        self.offroad_labeller = SafetyLabeller(args.safe_length_offroad)
+        self.idx_buffer = []
+
+    def store_frame(self, obs, info):
+        obs_var = super(BufferManager, self).store_frame(obs, info)
         self.spc_buffer.store_frame(obs=obs,
                                     collision=info['collision'],
                                     offroad=info['offroad'],
                                     speed=info['speed'],
                                     seg=info['seg'])
         self.idx_buffer.append(self.spc_buffer.last_idx)
-        self.dist_sum += info['speed']
+        if self.exporter is not None:
+            self.exporter.store_frame(obs, info['collision'], info['offroad'], info['speed'], info['seg'])
         return obs_var
 
     def store_effect(self, guide_action, action, reward, done, collision, offroad):
-        self.collision_buffer.append(collision)
-        self.offroad_buffer.append(offroad)
-        self.prev_act = copy.deepcopy(action)
-        act_var = Variable(torch.from_numpy(self.action_buffer.store_frame(action)), requires_grad=False).float()
+        self.collision_labeller.push(collision)
+        self.offroad_labeller.push(offroad)
         self.spc_buffer.store_action(guide_action, action, done)
-        self.reward += reward
-        return act_var
+        if self.exporter is not None:
+            self.exporter.store_action(guide_action, action, done)
+        return super(BufferManager, self).store_effect(guide_action, action, reward, done, collision, offroad)
 
     def reset(self, step):
-        self.obs_buffer.clear()
-        self.action_buffer.clear()
-        self.prev_act = np.array([1.0, 0.0])
-
         self.logger.info('step {} reward {}'.format(step, self.reward))
+        if self.args.obs_codec != 'raw' and self.spc_buffer.obs is not None:
+            stats = self.spc_buffer.obs.stats()
+            self.logger.info('obs codec {} bytes/frame {:.0f} (raw {}) encode {:.2f} ms decode {:.2f} ms'.format(
+                self.args.obs_codec, stats['bytes_per_frame'], stats['raw_bytes_per_frame'], stats['encode_ms'], stats['decode_ms']))
 
         # construct labels for self-imitation learning
         epi_len = len(self.idx_buffer)
         idx_buffer = np.array(self.idx_buffer)
-        collision_buffer = np.array(self.collision_buffer)
-        collision_buffer = np.array([np.sum(collision_buffer[i:i + self.args.safe_length_collision]) == 0 for i in range(collision_buffer.shape[0])])
-        offroad_buffer = np.array(self.offroad_buffer)
-        offroad_buffer = np.array([np.sum(offroad_buffer[i:i + self.args.safe_length_offroad]) == 0 for i in range(offroad_buffer.shape[0])])
-        safe_buffer = collision_buffer * offroad_buffer * self.dist_sum
-        self.spc_buffer.expert[idx_buffer] = safe_buffer
-        self.spc_buffer.epi_lens.append(epi_len)
+        safe_buffer = (self.collision_labeller.finish() & self.offroad_labeller.finish()) * self.dist_sum
+        self.spc_buffer.store_expert(idx_buffer, safe_buffer, epi_len)
+        if self.exporter is not None:
+            self.exporter.finish(safe_buffer)
+        if self.args.buffer_stats_freq > 0 and isinstance(self.spc_buffer, SPCBuffer) and len(self.spc_buffer.epi_lens) % self.args.buffer_stats_freq == 0:
+            self.log_buffer_stats()
 
         self.idx_buffer = []
-        self.collision_buffer = []
-        self.offroad_buffer = []
-        self.dist_sum = 0.0
-        self.reward = 0.0
+        self.clear()
+
+    def log_buffer_stats(self):
+        stats = self.spc_buffer.stats()
+        fields = ['{} {:.1f} MB ({})'.format(label, sum(field_bytes.values()) / 2 ** 20,
+                                            ', '.join('{} {:.1f}'.format(name, nbytes / 2 ** 20) for name, nbytes in field_bytes.items()))
+                  for label, field_bytes in [('memory', stats['field_bytes']), ('mapped', stats['mapped_bytes'])] if len(field_bytes) > 0]
+        self.logger.info('buffer fill {:.1%} ({}) valid {} episodes {} expert candidates {} rejected {} (guide {}) gather {:.2f} ms (p50 {:.2f} p99 {:.2f}) {}'.format(
+            stats['fill'], stats['num_in_buffer'], stats['num_valid'], stats['num_episodes'], stats['expert_candidates'],
+            stats['num_rejected'], stats['num_guide_rejected'], stats['gather_ms'], stats['gather_ms_p50'], stats['gather_ms_p99'], ' '.join(fields)))
 
     def save_spc_buffer(self):
-        return # Saving an object larger than 4 GiB causes overflow error
+        if not self.args.memmap_buffer:
+            return  # Pickling an object larger than 4 GiB causes overflow error
         self.spc_buffer.save(self.args.save_path)
 
     def load_spc_buffer(self):
@@ -130,7 +275,12 @@ class ActionSampleManager:
         self.guides = guides
         self.p = None
 
-    def sample_action(self, net, obs, obs_var, action_var, exploration, step, explore=False, testing=False):
+        # receding-horizon warm start: the best plan of the previous step and how often its candidates win
+        self.plan = None
+        self.num_warm_plans = 0
+        self.num_warm_wins = 0
+
+    def sample_action(self, net, obs, obs_var, action_var, exploration, step, explore=False, testing=False, feature_cache=None):
         if random.random() <= 1 - exploration.value(step) or not explore:
             if self.args.use_guidance:  # sample action distribution p
                 obs = Variable(torch.from_numpy(np.expand_dims(obs.transpose(2, 0, 1), axis=0)).float()) / 255.0
@@ -142,13 +292,30 @@ class ActionSampleManager:
                     p = F.softmax(self.p / self.args.temperature, dim=-1).data.cpu().numpy()
             else:
                 p = None
-            action = sample_action(self.args, p, net, obs_var, self.guides, action_var=action_var, testing=testing)
+            warm_start = self.warm_start_candidates() if self.args.warm_start and self.plan is not None else None
+            plan, from_warm_start = sample_action(self.args, p, net, obs_var, self.guides, action_var=action_var, testing=True, feature_cache=feature_cache, warm_start=warm_start)
+            if warm_start is not None:
+                self.num_warm_plans += 1
+                self.num_warm_wins += int(from_warm_start)
+            self.plan = plan
+            action = plan if testing else plan[0]
         else:
             action = np.random.rand(self.args.num_total_act) * 2 - 1
+            self.plan = None
         action = np.clip(action, -1, 1)
         guide_act = get_guide_action(self.args.bin_divide, action)
         self.prev_act = action
         return action, guide_act
 
+    def warm_start_candidates(self):
+        # previous best plan shifted by one step, repeating its last action, plus perturbed copies
+        shifted = np.concatenate([self.plan[1:], self.plan[-1:]], axis=0)
+        noise = self.args.warm_start_noise * np.random.randn(self.args.warm_start_perturbations, *shifted.shape)
+        return np.clip(np.concatenate([shifted[np.newaxis], shifted + noise], axis=0), -1, 1)
+
     def reset(self):
         self.prev_act = np.array([1.0, 0.0])
+        self.plan = None
+        if self.num_warm_plans > 0:
+            print('Warm-start candidates won %d of %d plans (%0.1f%%)' % (
+                self.num_warm_wins, self.num_warm_plans, 100.0 * self.num_warm_wins / self.num_warm_plans))
@@ -1,13 +1,307 @@
 from __future__ import division, print_function
 import numpy as np
 import os
-import random
+import bisect
+import collections
+import multiprocessing
+from multiprocessing import shared_memory
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import cv2
 import torch
 from torch.autograd import Variable
 import pickle
 
 
+def seg_bits(num_classes):
+    # bits per packed segmentation label
+    assert num_classes <= 16
+    return 2 if num_classes <= 4 else 4
+
+
+def pack_labels(labels, bits):
+    # pack a label map into uint8 bytes holding 8 // bits labels each
+    labels = np.asarray(labels, dtype=np.uint8).reshape(-1, 8 // bits)
+    shifts = np.arange(0, 8, bits, dtype=np.uint8)
+    return np.bitwise_or.reduce(labels << shifts, axis=-1)
+
+
+def unpack_labels(packed, bits, height, width):
+    shifts = np.arange(0, 8, bits, dtype=np.uint8)
+    labels = (packed[..., np.newaxis] >> shifts) & np.uint8((1 << bits) - 1)
+    return labels.reshape(packed.shape[:-1] + (height, width))
+
+
+class ChunkedArray(object):
+    """Array whose first axis is allocated in fixed-size chunks on first access, so a
+    replay buffer only commits memory for the frames it has actually stored."""
+    def __init__(self, shape, dtype, chunk_size):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.chunk_size = chunk_size
+        self.chunks = [None] * ((self.shape[0] + chunk_size - 1) // chunk_size)
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def nbytes(self):
+        return sum(chunk.nbytes for chunk in self.chunks if chunk is not None)
+
+    def chunk(self, c):
+        if self.chunks[c] is None:
+            length = min(self.chunk_size, self.shape[0] - c * self.chunk_size)
+            self.chunks[c] = np.zeros((length,) + self.shape[1:], dtype=self.dtype)
+        return self.chunks[c]
+
+    def _index(self, key):
+        if isinstance(key, tuple):
+            key, rest = key[0], key[1:]
+        else:
+            rest = ()
+        if isinstance(key, slice):
+            key = np.arange(*key.indices(self.shape[0]))
+        return key, rest
+
+    def __getitem__(self, key):
+        key, rest = self._index(key)
+        if np.ndim(key) == 0:
+            return self.chunk(key // self.chunk_size)[(key % self.chunk_size,) + rest]
+        out = self.take(key, mode='raise')
+        return out[(slice(None),) * np.ndim(key) + rest] if rest else out
+
+    def __setitem__(self, key, value):
+        key, rest = self._index(key)
+        if np.ndim(key) == 0:
+            self.chunk(key // self.chunk_size)[(key % self.chunk_size,) + rest] = value
+            return
+        key = np.asarray(key).reshape(-1)
+        value = np.broadcast_to(value, key.shape + self.shape[1:])
+        chunk_ids = key // self.chunk_size
+        for c in np.unique(chunk_ids):
+            mask = chunk_ids == c
+            self.chunk(c)[(key[mask] - c * self.chunk_size,) + rest] = value[mask]
+
+    def take(self, indices, axis=0, out=None, mode='wrap'):
+        assert axis == 0
+        indices = np.asarray(indices)
+        if mode == 'wrap':
+            indices = indices % self.shape[0]
+        if out is None:
+            out = np.empty(indices.shape + self.shape[1:], dtype=self.dtype)
+        flat_out, flat_indices = out.reshape((-1,) + self.shape[1:]), indices.reshape(-1)
+        chunk_ids = flat_indices // self.chunk_size
+        for c in np.unique(chunk_ids):
+            mask = chunk_ids == c
+            flat_out[mask] = self.chunk(c)[flat_indices[mask] - c * self.chunk_size]
+        return out
+
+
+class CompressedFrameStore(object):
+    """Drop-in replacement for the [size, 3, H, W] uint8 observation array that keeps
+    every frame as an encoded image and decodes gathered frames on a thread pool."""
+    def __init__(self, size, height, width, codec='png', quality=95, num_workers=4):
+        self.shape = (size, 3, height, width)
+        self.dtype = np.dtype(np.uint8)
+        self.codec = codec
+        self.quality = quality
+        self.num_workers = num_workers
+        if codec == 'png':
+            self.ext, self.params = '.png', [cv2.IMWRITE_PNG_COMPRESSION, 1]
+        elif codec == 'webp':
+            self.ext, self.params = '.webp', [cv2.IMWRITE_WEBP_QUALITY, 101]  # quality above 100 is lossless
+        elif codec == 'jpeg':
+            self.ext, self.params = '.jpg', [cv2.IMWRITE_JPEG_QUALITY, quality]
+        else:
+            raise ValueError('Unknown observation codec %s' % codec)
+
+        # preallocated chunk index, one encoded frame per buffer slot
+        self.codes = np.empty([size], dtype=object)
+        self.nbytes = np.zeros([size], dtype=np.int64)
+        self.executor = ThreadPoolExecutor(max_workers=num_workers)
+
+        self.num_encoded = 0
+        self.encode_time = 0.0
+        self.num_decoded = 0
+        self.decode_time = 0.0
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __setitem__(self, idx, frame):
+        start_time = time.time()
+        ok, code = cv2.imencode(self.ext, np.ascontiguousarray(frame.transpose(1, 2, 0)), self.params)
+        assert ok
+        self.codes[idx] = code
+        self.nbytes[idx] = code.nbytes
+        self.encode_time += time.time() - start_time
+        self.num_encoded += 1
+
+    def __getitem__(self, idx):
+        return self.take(np.asarray(idx))
+
+    def decode(self, idx):
+        return cv2.imdecode(self.codes[idx], cv2.IMREAD_COLOR).transpose(2, 0, 1)
+
+    def take(self, indices, axis=0, out=None, mode='wrap'):
+        assert axis == 0 and mode == 'wrap'
+        indices = np.asarray(indices) % self.shape[0]
+        if out is None:
+            out = np.empty(indices.shape + self.shape[1:], dtype=self.dtype)
+        # decode each distinct frame once, then scatter it to every position that uses it
+        unique, inverse = np.unique(indices, return_inverse=True)
+        start_time = time.time()
+        frames = list(self.executor.map(self.decode, unique))
+        self.decode_time += time.time() - start_time
+        self.num_decoded += len(unique)
+        out.reshape((-1,) + self.shape[1:])[:] = np.stack(frames)[inverse.reshape(-1)]
+        return out
+
+    def stats(self):
+        num_frames = max(int(np.count_nonzero(self.nbytes)), 1)
+        return {'bytes_per_frame': float(np.sum(self.nbytes)) / num_frames,
+                'raw_bytes_per_frame': int(np.prod(self.shape[1:])),
+                'encode_ms': 1000.0 * self.encode_time / max(self.num_encoded, 1),
+                'decode_ms': 1000.0 * self.decode_time / max(self.num_decoded, 1)}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['executor']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.executor = ThreadPoolExecutor(max_workers=self.num_workers)
+
+
+def last_occurrence(indices, expert):
+    # a wrapped episode lists a slot once per lap; only its last label holds
+    indices = np.asarray(indices, dtype=np.int64)
+    expert = np.broadcast_to(np.asarray(expert, dtype=np.float32), indices.shape)
+    _, pos = np.unique(indices[::-1], return_index=True)
+    pos = len(indices) - 1 - pos
+    return indices[pos], expert[pos]
+
+
+class ExpertIndex(object):
+    """Self-imitation candidates grouped by expert value, kept sorted so that the
+    slots at or above a bar can be counted and sampled without scanning the buffer."""
+    def __init__(self, size):
+        self.slot_group = np.full([size], -1, dtype=np.int64)
+        self.slot_pos = np.zeros([size], dtype=np.int64)
+        self.groups = dict()
+        self.values = []  # group values in ascending order
+        self.group_ids = []  # group ids in the same order as values
+        self.num_groups = 0
+
+    def add(self, indices, expert):
+        indices, expert = last_occurrence(indices, expert)
+        for idx in indices:
+            self.discard(idx)
+        values, inverse = np.unique(expert, return_inverse=True)
+        for i, value in enumerate(values):
+            slots = indices[inverse.reshape(-1) == i].copy()
+            gid = self.num_groups
+            self.num_groups += 1
+            self.groups[gid] = {'value': float(value), 'slots': slots, 'count': len(slots)}
+            self.slot_group[slots] = gid
+            self.slot_pos[slots] = np.arange(len(slots))
+            pos = bisect.bisect_right(self.values, float(value))
+            self.values.insert(pos, float(value))
+            self.group_ids.insert(pos, gid)
+
+    def discard(self, idx):
+        gid = self.slot_group[idx]
+        if gid < 0:
+            return
+        group = self.groups[gid]
+        pos, last = self.slot_pos[idx], group['slots'][group['count'] - 1]
+        group['slots'][pos] = last
+        self.slot_pos[last] = pos
+        group['count'] -= 1
+        self.slot_group[idx] = -1
+        if group['count'] == 0:
+            pos = bisect.bisect_left(self.values, group['value'])
+            pos += self.group_ids[pos:].index(gid)
+            del self.values[pos]
+            del self.group_ids[pos]
+            del self.groups[gid]
+
+    def count(self, bar):
+        return sum(self.groups[gid]['count'] for gid in self.group_ids[bisect.bisect_left(self.values, bar):])
+
+    def sample(self, bar, batch_size):
+        # uniform draw with replacement over all slots whose expert value reaches the bar
+        groups = [self.groups[gid] for gid in self.group_ids[bisect.bisect_left(self.values, bar):]]
+        cum_counts = np.cumsum([group['count'] for group in groups])
+        draws = np.random.randint(cum_counts[-1], size=batch_size)
+        which = np.searchsorted(cum_counts, draws, side='right')
+        offsets = draws - (cum_counts[which] - [groups[g]['count'] for g in which])
+        return np.array([groups[g]['slots'][o] for g, o in zip(which, offsets)], dtype=np.int64)
+
+
+class SumTree(object):
+    """Binary sum tree over buffer positions for prioritized replay: O(log N) updates and draws."""
+    def __init__(self, size):
+        self.capacity = 1
+        while self.capacity < size:
+            self.capacity *= 2
+        self.tree = np.zeros([2 * self.capacity], dtype=np.float64)
+        self.lock = threading.Lock()  # prefetch workers draw while the trainer updates
+
+    def total(self):
+        return self.tree[1]
+
+    def get(self, indices):
+        return self.tree[np.asarray(indices) + self.capacity]
+
+    def set(self, idx, priority):
+        node = idx + self.capacity
+        with self.lock:
+            self.tree[node] = priority
+            node //= 2
+            while node >= 1:
+                self.tree[node] = self.tree[2 * node] + self.tree[2 * node + 1]
+                node //= 2
+
+    def update(self, indices, priorities):
+        nodes = np.asarray(indices, dtype=np.int64) + self.capacity
+        with self.lock:
+            self.tree[nodes] = priorities
+            nodes = np.unique(nodes // 2)
+            while nodes[0] >= 1:
+                self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+                nodes = np.unique(nodes // 2)
+
+    def find(self, values):
+        # descend to the leaf whose prefix-sum interval contains each value
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(values.shape, dtype=np.int64)
+        with self.lock:
+            while nodes[0] < self.capacity:
+                left = 2 * nodes
+                go_right = (values >= self.tree[left]) & (self.tree[left + 1] > 0)
+                values -= np.where(go_right, self.tree[left], 0)
+                nodes = left + go_right
+        return nodes - self.capacity
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+
 class SPCBuffer(object):
+    # small state saved next to the memory-mapped fields
+    meta_keys = ['next_idx', 'num_in_buffer', 'last_idx', 'epi_lens',
+                 'episode_id', 'episodes', 'cur_episode', 'num_episodes', 'new_episode']
+
     def __init__(self, args):
         self.args = args
 
@@ -26,6 +320,88 @@ class SPCBuffer(object):
         self.guide_action = None
         self.epi_lens = []
 
+        # set of buffer positions whose sample window is complete and crosses no episode end
+        self.valid_starts = np.empty([args.buffer_size], dtype=np.int64)
+        self.valid_pos = np.full([args.buffer_size], -1, dtype=np.int64)
+        self.num_valid = 0
+        self.run_len = 0  # number of consecutive frames written since the last done
+
+        # episode bookkeeping for --episodic-buffer
+        self.episode_id = np.full([args.buffer_size], -1, dtype=np.int64)
+        self.episodes = dict()
+        self.cur_episode = -1
+        self.num_episodes = 0
+        self.new_episode = True
+
+        # incremental self-imitation bookkeeping
+        self.sorted_epi_lens = []
+        self.expert_index = ExpertIndex(args.buffer_size)
+
+        # priorities of valid starts for --prioritized-replay, stored already raised to priority_alpha
+        self.priority_tree = SumTree(args.buffer_size) if args.prioritized_replay else None
+        self.max_priority = 1.0
+
+        self.reset_stats()
+
+    def reset_stats(self):
+        # telemetry counters; gather latencies are bucketed by log2 of microseconds
+        self.num_samples = 0
+        self.num_rejected = 0
+        self.num_guide_rejected = 0
+        self.gather_time = 0.0
+        self.gather_hist = np.zeros([32], dtype=np.int64)
+
+    def record_gather(self, start_time):
+        elapsed = time.time() - start_time
+        self.num_samples += 1
+        self.gather_time += elapsed
+        self.gather_hist[min(max(int(np.log2(max(elapsed * 1e6, 1.0))), 0), len(self.gather_hist) - 1)] += 1
+
+    def gather_percentile(self, q):
+        # upper edge of the histogram bucket holding the q-th percentile, in milliseconds
+        if self.num_samples == 0:
+            return 0.0
+        bucket = int(np.searchsorted(np.cumsum(self.gather_hist), q / 100.0 * np.sum(self.gather_hist)))
+        return 2.0 ** (bucket + 1) / 1000.0
+
+    def record_rejection(self, guide=False):
+        # a learning step that found too little data to sample from, or too little expert data for guidance
+        if guide:
+            self.num_guide_rejected += 1
+        else:
+            self.num_rejected += 1
+
+    def field_bytes(self):
+        # allocated bytes per field; memory-mapped fields are listed apart since only the pages
+        # the page cache holds are resident
+        field_bytes, mapped_bytes = dict(), dict()
+        for name, _, _ in self.field_specs():
+            array = getattr(self, name)
+            if isinstance(array, CompressedFrameStore):
+                field_bytes[name] = int(np.sum(array.nbytes))
+            elif isinstance(array, np.memmap):
+                mapped_bytes[name] = int(array.nbytes)
+            else:
+                field_bytes[name] = int(getattr(array, 'nbytes', 0))
+        return field_bytes, mapped_bytes
+
+    def stats(self):
+        field_bytes, mapped_bytes = self.field_bytes()
+        num_candidates = self.expert_index.count(self.get_bar()) if len(self.sorted_epi_lens) > 0 else 0
+        return {'num_in_buffer': self.num_in_buffer,
+                'fill': self.num_in_buffer / self.args.buffer_size,
+                'num_valid': self.num_valid,
+                'num_episodes': len(self.epi_lens),
+                'num_samples': self.num_samples,
+                'num_rejected': self.num_rejected,
+                'num_guide_rejected': self.num_guide_rejected,
+                'gather_ms': 1000.0 * self.gather_time / max(self.num_samples, 1),
+                'gather_ms_p50': self.gather_percentile(50),
+                'gather_ms_p99': self.gather_percentile(99),
+                'expert_candidates': num_candidates,
+                'field_bytes': field_bytes,
+                'mapped_bytes': mapped_bytes}
+
     def can_sample_guide(self, batch_size):
         # determines whether there are enough expert data for self-imitation learning
         if len(self.epi_lens) == 0:
@@ -35,96 +411,185 @@ class SPCBuffer(object):
         bar = self.get_bar()
         if self.args.verbose:
             print('Bar: %d' % bar)
-        bar_index = np.where(self.expert[:self.num_in_buffer] >= bar)[0]
+        num_candidates = self.expert_index.count(bar)
         if self.args.verbose:
-            print('Number of candidates: %d' % len(bar_index))
-        return len(bar_index) >= batch_size
+            print('Number of candidates: %d' % num_candidates)
+        return num_candidates >= batch_size
 
     def get_bar(self):
         # calculate the bar according to which expert guidance data are selected
-        idx = int(len(self.epi_lens) * self.args.expert_ratio)
-        bar = max(sorted(self.epi_lens, reverse=True)[idx], self.args.expert_bar)
+        idx = int(len(self.sorted_epi_lens) * self.args.expert_ratio)
+        bar = max(self.sorted_epi_lens[-1 - idx], self.args.expert_bar)
         return bar
 
+    def sample_guide_data(self, batch_size):
+        # sample expert guidance replay data for self-imitation learning as numpy arrays
+        indices = self.expert_index.sample(self.get_bar(), batch_size)
+        return {'obs': self._take(self.obs, indices),
+                'guide_action': self._take(self.guide_action, indices)}
+
     def sample_guide(self, batch_size):
-        # sample expert guidance replay data for self-imitation learning
-        indices = np.where(self.expert[:self.num_in_buffer] >= self.get_bar())[0]
-        indices = list(np.random.choice(list(indices), batch_size))
-        obs = Variable(torch.from_numpy(np.concatenate([self.obs[idx][np.newaxis, :] for idx in indices], axis=0)).float() / 255.0, requires_grad=False)
-        guide_action = Variable(torch.from_numpy(self.guide_action[indices]), requires_grad=False).long()
+        data_dict = self.sample_guide_data(batch_size)
+        obs = Variable(torch.from_numpy(data_dict['obs']).float() / 255.0, requires_grad=False)
+        guide_action = Variable(torch.from_numpy(data_dict['guide_action']), requires_grad=False).long()
 
         if torch.cuda.is_available():
             obs = obs.cuda()
             guide_action = guide_action.cuda()
         return obs, guide_action
 
-    def sample_n_unique(self, sampling_f, n):
-        res = []
-        while len(res) < n:
-            candidate = sampling_f()
-            done = self.sample_done(candidate)
-            if candidate not in res and done:
-                res.append(candidate)
-        return res
-
-    def sample_done(self, idx):
-        if idx < 10 or idx >= self.num_in_buffer - self.args.pred_step - 10:
-            return False
-        else:
-            done_list = self.done[idx-self.args.frame_history_len+1: idx+self.args.pred_step+1]
-            if np.sum(done_list) >= 1.0:
-                return False
-            else:
-                return True
+    def add_valid_start(self, idx):
+        if self.valid_pos[idx] < 0:
+            self.valid_pos[idx] = self.num_valid
+            self.valid_starts[self.num_valid] = idx
+            self.num_valid += 1
+            if self.priority_tree is not None:
+                self.priority_tree.set(idx, self.initial_priority(idx))
+
+    def remove_valid_start(self, idx):
+        pos = self.valid_pos[idx]
+        if pos >= 0:
+            last = self.valid_starts[self.num_valid - 1]
+            self.valid_starts[pos] = last
+            self.valid_pos[last] = pos
+            self.valid_pos[idx] = -1
+            self.num_valid -= 1
+            if self.priority_tree is not None:
+                self.priority_tree.set(idx, 0.0)
+
+    def initial_priority(self, idx):
+        # new windows get the highest priority seen so far, windows with a collision or off-road event a bonus on top
+        window = np.arange(idx + 1, idx + self.args.pred_step + 1) % self.args.buffer_size
+        event = np.any(self.collision[window]) or np.any(self.offroad[window])
+        return self.max_priority + self.args.priority_event_bonus * event
+
+    def update_priorities(self, indices, losses):
+        priorities = (np.abs(losses) + self.args.priority_eps) ** self.args.priority_alpha
+        self.max_priority = max(self.max_priority, float(np.max(priorities)))
+        # drop updates for windows that were overwritten since they were sampled
+        keep = self.valid_pos[indices] >= 0
+        if np.any(keep):
+            self.priority_tree.update(indices[keep], priorities[keep])
+
+    def rebuild_valid_starts(self):
+        # recompute the valid-start set from the done flags, e.g. after loading a saved buffer
+        self.valid_starts = np.empty([self.args.buffer_size], dtype=np.int64)
+        self.valid_pos = np.full([self.args.buffer_size], -1, dtype=np.int64)
+        self.num_valid = 0
+        self.run_len = 0
+        if self.args.prioritized_replay:
+            self.priority_tree = SumTree(self.args.buffer_size)
+        if self.num_in_buffer == 0:
+            return
+        order = (np.arange(self.num_in_buffer) + (self.next_idx if self.num_in_buffer == self.args.buffer_size else 0)) % self.args.buffer_size
+        steps = np.arange(self.num_in_buffer)
+        last_done = np.where(self.done[order] != 0, steps, -1)
+        if self.args.episodic_buffer:
+            # evicted slots are never sampled, and pinned episodes can sit between frames of a later episode
+            owner = self.episode_id[order]
+            last_done[owner < 0] = steps[owner < 0]
+            last_done[1:] = np.maximum(last_done[1:], np.where(owner[1:] != owner[:-1], steps[:-1], -1))
+        last_done = np.maximum.accumulate(last_done)
+        run_len = steps - last_done
+        window_len = self.args.frame_history_len + self.args.pred_step
+        for t in np.where(run_len >= window_len)[0]:
+            self.add_valid_start(order[t - self.args.pred_step])
+        self.run_len = int(run_len[-1])
 
     def can_sample(self, batch_size):
-        return batch_size * self.args.pred_step + 1 <= self.num_in_buffer
+        return batch_size * self.args.pred_step + 1 <= self.num_in_buffer and batch_size <= self.num_valid
 
-    def _encode_sample(self, indices):
+    def _encode_sample(self, indices, fields=None):
+        # `fields` limits the gather to the listed keys; 'nx_obs' extends obs_strip over the next-observation windows
+        start_time = time.time()
         data_dict = dict()
+        frame_history_len, pred_step = self.args.frame_history_len, self.args.pred_step
 
-        data_dict['obs_batch'] = np.concatenate([np.concatenate([self._encode_observation(idx+ii)[np.newaxis,:] for ii in range(self.args.pred_step)], 0)[np.newaxis, :] for idx in indices], axis=0)
-        data_dict['nx_obs_batch'] = np.concatenate([np.concatenate([self._encode_observation(idx+1+ii)[np.newaxis,:] for ii in range(self.args.pred_step)], 0)[np.newaxis, :] for idx in indices], axis=0)
-        data_dict['act_batch'] = np.concatenate([self.action[idx: idx+self.args.pred_step, :][np.newaxis, :] for idx in indices], axis=0)
-        data_dict['sp_batch'] = np.concatenate([self.speed[idx: idx+self.args.pred_step+1][np.newaxis, :] for idx in indices], axis=0)
-        data_dict['prev_action'] = np.concatenate([self.action[idx-self.args.frame_history_len+1: idx, :][np.newaxis, :] for idx in indices], axis=0)
-        data_dict['coll_batch'] = np.concatenate([self.collision[idx+1: idx+self.args.pred_step+1][np.newaxis, :] for idx in indices], axis=0)
-        data_dict['off_batch'] = np.concatenate([self.offroad[idx+1: idx+self.args.pred_step+1][np.newaxis, :] for idx in indices], axis=0)
-        data_dict['seg_batch'] = np.concatenate([self.seg[idx: idx+self.args.pred_step+1, :][np.newaxis, :] for idx in indices], axis=0)
+        # buffer positions of every frame a sample touches, from the oldest history frame to the last predicted one
+        window = np.asarray(indices).reshape(-1, 1) + np.arange(1 - frame_history_len, pred_step + 1)
+        current = window[:, frame_history_len - 1:]
 
+        # every frame once; the model stacks the overlapping frame_history_len windows itself
+        if fields is None or 'nx_obs' in fields:
+            data_dict['obs_strip'] = self._take(self.obs, window)
+        elif 'obs_strip' in fields:
+            data_dict['obs_strip'] = self._take(self.obs, window[:, :frame_history_len])
+
+        if fields is None or 'act_batch' in fields or 'prev_action' in fields:
+            actions = self._take(self.action, window[:, :-1])
+            data_dict['act_batch'] = actions[:, frame_history_len - 1:]
+            data_dict['prev_action'] = actions[:, :frame_history_len - 1]
+        if fields is None or 'sp_batch' in fields:
+            data_dict['sp_batch'] = self._take(self.speed, current)
+        if fields is None or 'coll_batch' in fields:
+            data_dict['coll_batch'] = self._take(self.collision, current[:, 1:])
+        if fields is None or 'off_batch' in fields:
+            data_dict['off_batch'] = self._take(self.offroad, current[:, 1:])
+        if fields is None or 'seg_batch' in fields:
+            data_dict['seg_batch'] = self._take_seg(current)
+
+        self.record_gather(start_time)
         return data_dict
 
-    def sample(self, batch_size):
+    def _take(self, array, index):
+        # single fancy-indexing gather into a preallocated output; positions wrap around the ring
+        out = np.empty(index.shape + array.shape[1:], dtype=array.dtype)
+        array.take(index, axis=0, out=out, mode='wrap')
+        return out
+
+    def _take_seg(self, index):
+        if not self.args.pack_seg:
+            return self._take(self.seg, index)
+        return unpack_labels(self._take(self.seg, index), seg_bits(self.args.classes), self.args.frame_height, self.args.frame_width)
+
+    def sample(self, batch_size, fields=None):
         assert self.can_sample(batch_size)
-        indices = self.sample_n_unique(lambda: random.randint(10, self.num_in_buffer - 10), batch_size)
-        return self._encode_sample(indices)
+        if self.priority_tree is None:
+            indices = self.valid_starts[np.random.choice(self.num_valid, batch_size, replace=False)]
+            return self._encode_sample(indices, fields)
 
-    def _encode_observation(self, idx):
-        start_idx = idx - self.args.frame_history_len + 1
-        end_idx = idx + 1
-        assert start_idx >= 0 and end_idx <= min(self.num_in_buffer, self.args.buffer_size) and np.sum(self.done[start_idx: end_idx]) == 0
-        return self.obs[start_idx: end_idx].reshape(-1, self.args.frame_height, self.args.frame_width)
+        # stratified proportional draw with importance-sampling weights
+        total = self.priority_tree.total()
+        indices = self.priority_tree.find((np.arange(batch_size) + np.random.rand(batch_size)) * total / batch_size)
+        probs = self.priority_tree.get(indices) / total
+        weights = (self.num_valid * probs) ** -self.args.priority_beta
+        data_dict = self._encode_sample(indices, fields)
+        data_dict['idx_batch'] = indices
+        data_dict['is_weight'] = (weights / np.max(weights)).astype(np.float32)
+        return data_dict
 
     def store_frame(self, obs, collision, offroad, speed, seg):
         assert obs.shape == (self.args.frame_height, self.args.frame_width, 3)
         frame = obs.transpose(2, 0, 1)  # reshape as [C, H, W]
 
         if self.obs is None:
-            self.obs = np.empty([self.args.buffer_size, 3, self.args.frame_height, self.args.frame_width], dtype=np.uint8)
-            self.action = np.empty([self.args.buffer_size, self.args.num_total_act], dtype=np.float32)
-            self.done = np.empty([self.args.buffer_size], dtype=np.int32)
-            self.expert = np.empty([self.args.buffer_size], dtype=np.float32)
-            self.guide_action = np.empty([self.args.buffer_size], dtype=np.int32)
-            self.collision = np.empty([self.args.buffer_size], dtype=np.int32)
-            self.offroad = np.empty([self.args.buffer_size], dtype=np.int32)
-            self.speed = np.empty([self.args.buffer_size], dtype=np.float32)
-            self.seg = np.empty([self.args.buffer_size, self.args.frame_height, self.args.frame_width], dtype=np.uint8)
+            self.allocate()
+
+        if self.args.episodic_buffer:
+            if self.new_episode:
+                self.cur_episode = self.num_episodes
+                self.num_episodes += 1
+                self.episodes[self.cur_episode] = {'pin_laps': 0, 'length': 0}
+                self.new_episode = False
+            self.make_room()
+            self.episode_id[self.next_idx] = self.cur_episode
+
+        # the overwritten frame stops being a self-imitation candidate until its episode is labelled
+        self.expert_index.discard(self.next_idx)
+
+        # windows that contain the overwritten frame are no longer valid
+        if self.num_valid > 0:
+            for idx in range(self.next_idx - self.args.pred_step, self.next_idx + self.args.frame_history_len):
+                self.remove_valid_start(idx % self.args.buffer_size)
 
         self.obs[self.next_idx] = frame
         self.collision[self.next_idx] = int(collision)
         self.offroad[self.next_idx] = int(offroad)
         self.speed[self.next_idx] = speed
-        self.seg[self.next_idx, :] = seg
+        if self.args.pack_seg:
+            self.seg[self.next_idx, :] = pack_labels(seg, seg_bits(self.args.classes))
+        else:
+            self.seg[self.next_idx, :] = seg
 
         self.last_idx = self.next_idx
         self.next_idx = (self.next_idx + 1) % self.args.buffer_size
@@ -135,11 +600,329 @@ class SPCBuffer(object):
         self.action[self.last_idx, :] = action
         self.done[self.last_idx] = int(done)
 
+        # the window ending at this frame becomes sampleable once it spans a full done-free run
+        self.run_len = 0 if done else self.run_len + 1
+        if self.run_len >= self.args.frame_history_len + self.args.pred_step:
+            self.add_valid_start((self.last_idx - self.args.pred_step) % self.args.buffer_size)
+        if done:
+            self.new_episode = True
+
+    def store_expert(self, indices, expert, epi_len):
+        # self-imitation labels of a finished episode
+        indices, expert = last_occurrence(indices, expert)
+        self.expert[indices] = expert
+        self.expert_index.add(indices, expert)
+        self.epi_lens.append(epi_len)
+        bisect.insort(self.sorted_epi_lens, epi_len)
+        if self.args.episodic_buffer and len(indices) > 0 and self.args.pin_expert_laps > 0:
+            owner = self.episode_id[indices[-1]]
+            # pinned episodes may take at most half of the buffer so that new episodes always fit
+            pinned = sum(episode['length'] for episode in self.episodes.values() if episode['pin_laps'] > 0)
+            if owner in self.episodes and np.max(expert) >= self.get_bar() and pinned + len(indices) <= self.args.buffer_size // 2:
+                self.episodes[owner]['pin_laps'] = self.args.pin_expert_laps
+                self.episodes[owner]['length'] = len(indices)
+
+    def make_room(self):
+        # evict the whole episode under the write head; pinned episodes are skipped for another lap instead
+        while True:
+            owner = self.episode_id[self.next_idx]
+            if owner < 0 or owner == self.cur_episode:
+                return
+            end_idx, length = self.next_idx, 0
+            while self.episode_id[end_idx] == owner and length < self.args.buffer_size:
+                end_idx = (end_idx + 1) % self.args.buffer_size
+                length += 1
+            # skipping must not run the write head into the episode being written, and an episode
+            # that fills the whole ring cannot be skipped at all
+            if self.episodes[owner]['pin_laps'] > 0 and length < self.args.buffer_size and self.episode_id[end_idx] != self.cur_episode:
+                self.episodes[owner]['pin_laps'] -= 1
+                self.next_idx = end_idx
+                self.run_len = 0  # no sample window may straddle the skipped episode
+            else:
+                self.evict_episode(owner)
+
+    def evict_episode(self, owner):
+        slots = np.where(self.episode_id == owner)[0]
+        for idx in slots:
+            self.remove_valid_start(idx)
+        self.expert[slots] = 0
+        for idx in slots:
+            self.expert_index.discard(idx)
+        self.episode_id[slots] = -1
+        del self.episodes[owner]
+
+    def field_specs(self):
+        size, height, width = self.args.buffer_size, self.args.frame_height, self.args.frame_width
+        return [('obs', (size, 3, height, width), np.uint8),
+                ('action', (size, self.args.num_total_act), np.float32),
+                ('done', (size,), np.int32),
+                ('expert', (size,), np.float32),
+                ('guide_action', (size,), np.int32),
+                ('collision', (size,), np.int32),
+                ('offroad', (size,), np.int32),
+                ('speed', (size,), np.float32),
+                ('seg', (size, height * width * seg_bits(self.args.classes) // 8) if self.args.pack_seg else (size, height, width), np.uint8)]
+
+    def allocate(self, path=None, mode='w+'):
+        # with --memmap-buffer every field lives in a file under `path` instead of in RAM
+        if self.args.memmap_buffer:
+            buffer_dir = os.path.join(path or self.args.save_path, 'spc_buffer')
+            if not os.path.isdir(buffer_dir):
+                os.makedirs(buffer_dir)
+        for name, shape, dtype in self.field_specs():
+            if name == 'obs' and self.args.obs_codec != 'raw':
+                array = CompressedFrameStore(self.args.buffer_size, self.args.frame_height, self.args.frame_width,
+                                             self.args.obs_codec, self.args.obs_quality, self.args.obs_decode_workers)
+            elif self.args.memmap_buffer:
+                array = np.memmap(os.path.join(buffer_dir, name + '.dat'), dtype=dtype, mode=mode, shape=shape)
+            elif self.args.buffer_chunk_size > 0:
+                array = ChunkedArray(shape, dtype, self.args.buffer_chunk_size)
+            else:
+                array = np.empty(shape, dtype=dtype)
+            setattr(self, name, array)
+
     def load(self, path):
-        if os.path.exists(os.path.join(path, 'spc_buffer.pkl')):
+        if self.args.memmap_buffer:
+            meta_path = os.path.join(path, 'spc_buffer', 'meta.pkl')
+            if os.path.exists(meta_path):
+                with open(meta_path, 'rb') as f:
+                    meta = pickle.load(f)
+                # map the saved fields back without reading them into RAM
+                self.allocate(path, mode='r+')
+                for key in self.meta_keys:
+                    if key in meta:
+                        setattr(self, key, meta[key])
+        elif os.path.exists(os.path.join(path, 'spc_buffer.pkl')):
             with open(os.path.join(path, 'spc_buffer.pkl'), 'rb') as f:
                 self.__dict__ = pickle.load(f)
+        self.reset_stats()
+        if self.obs is not None:
+            self.rebuild_valid_starts()
+            self.sorted_epi_lens = sorted(self.epi_lens)
+            self.expert_index = ExpertIndex(self.args.buffer_size)
+            self.expert_index.add(np.arange(self.num_in_buffer), self.expert[:self.num_in_buffer])
+
+    def save(self, path):
+        if self.args.memmap_buffer:
+            if self.obs is None:
+                return
+            for name, _, _ in self.field_specs():
+                getattr(self, name).flush()
+            meta = dict((key, getattr(self, key)) for key in self.meta_keys)
+            meta_path = os.path.join(path, 'spc_buffer', 'meta.pkl')
+            with open(meta_path + '.tmp', 'wb') as f:
+                pickle.dump(meta, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(meta_path + '.tmp', meta_path)
+        else:
+            with open(os.path.join(path, 'spc_buffer.pkl'), 'wb') as f:
+                pickle.dump(self.__dict__, f)
+
+
+class SharedSPCBuffer(SPCBuffer):
+    """SPCBuffer whose fields live in shared memory, so that several actor processes can write
+    while a learner process samples. The creating process owns the segments; other processes
+    pass `handle` (e.g. as a Process argument) to map the same memory.
+
+    Each writer reserves blocks of --shared-block-size slots under a lock and keeps its own episode
+    bookkeeping, so sample windows never cross block boundaries. Readers see whatever the writers
+    have stored; a window whose block is being recycled may be read while it is overwritten."""
+    # header slots
+    NEXT_BLOCK, NUM_IN_BUFFER, NUM_EPI_LENS = range(3)
+
+    def __init__(self, args, handle=None):
+        super(SharedSPCBuffer, self).__init__(args)
+        assert not (args.memmap_buffer or args.episodic_buffer or args.prioritized_replay) and args.obs_codec == 'raw', \
+            'shared buffers only support plain in-memory fields'
+        self.block_size = args.shared_block_size
+        assert args.buffer_size % self.block_size == 0, 'buffer size must be a multiple of the shared block size'
+        assert self.block_size >= args.frame_history_len + args.pred_step, 'a shared block must hold a full sample window'
+
+        self.owner = handle is None
+        specs = self.field_specs() + [('valid', (args.buffer_size,), np.uint8),
+                                      ('shared_epi_lens', (args.buffer_size,), np.int64),
+                                      ('block_generation', (args.buffer_size // self.block_size,), np.int64),
+                                      ('header', (3,), np.int64)]
+        self.lock = multiprocessing.get_context('spawn').Lock() if handle is None else handle['lock']
+        self.segments = dict()
+        for name, shape, dtype in specs:
+            if handle is None:
+                segment = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize))
+            else:
+                segment = shared_memory.SharedMemory(name=handle['names'][name])
+            self.segments[name] = segment
+            array = np.ndarray(shape, dtype=dtype, buffer=segment.buf)
+            if handle is None:
+                array.fill(0)
+            setattr(self, name, array)
+
+        # per-writer state: the block being filled is [next_idx, block_end), reserved as generation
+        # `generation`; `slot_generation` remembers the generation every slot was written under
+        self.block_end = self.next_idx
+        self.generation = -1
+        self.slot_generation = np.full([args.buffer_size], -1, dtype=np.int64)
+
+    @property
+    def handle(self):
+        return {'names': dict((name, segment.name) for name, segment in self.segments.items()), 'lock': self.lock}
+
+    def close(self):
+        for name in list(self.segments):
+            # drop the array views before the mapping goes away
+            setattr(self, name, None)
+        for segment in self.segments.values():
+            segment.close()
+            if self.owner:
+                segment.unlink()
+        self.segments = dict()
+
+    def reserve_block(self):
+        with self.lock:
+            start = int(self.header[self.NEXT_BLOCK])
+            self.header[self.NEXT_BLOCK] = (start + self.block_size) % self.args.buffer_size
+            self.header[self.NUM_IN_BUFFER] = min(self.args.buffer_size, self.header[self.NUM_IN_BUFFER] + self.block_size)
+            # windows and self-imitation labels in the recycled block are gone
+            self.valid[start:start + self.block_size] = 0
+            self.expert[start:start + self.block_size] = 0
+            self.block_generation[start // self.block_size] += 1
+            self.generation = int(self.block_generation[start // self.block_size])
+        self.next_idx, self.block_end = start, start + self.block_size
+        self.run_len = 0
+
+    def store_frame(self, obs, collision, offroad, speed, seg):
+        assert obs.shape == (self.args.frame_height, self.args.frame_width, 3)
+        if self.next_idx == self.block_end:
+            self.reserve_block()
+
+        self.obs[self.next_idx] = obs.transpose(2, 0, 1)
+        self.collision[self.next_idx] = int(collision)
+        self.offroad[self.next_idx] = int(offroad)
+        self.speed[self.next_idx] = speed
+        if self.args.pack_seg:
+            self.seg[self.next_idx, :] = pack_labels(seg, seg_bits(self.args.classes))
+        else:
+            self.seg[self.next_idx, :] = seg
+        self.slot_generation[self.next_idx] = self.generation
+
+        self.last_idx = self.next_idx
+        self.next_idx += 1
+
+    def store_action(self, guide_action, action, done):
+        self.guide_action[self.last_idx] = guide_action
+        self.action[self.last_idx, :] = action
+        self.done[self.last_idx] = int(done)
+
+        self.run_len = 0 if done else self.run_len + 1
+        if self.run_len >= self.args.frame_history_len + self.args.pred_step:
+            self.valid[self.last_idx - self.args.pred_step] = 1
+
+    def store_expert(self, indices, expert, epi_len):
+        indices = np.asarray(indices, dtype=np.int64)
+        expert = np.broadcast_to(np.asarray(expert, dtype=self.expert.dtype), indices.shape)
+        with self.lock:
+            # slots another writer has reserved since this episode wrote them belong to that writer now
+            owned = self.slot_generation[indices] == self.block_generation[indices // self.block_size]
+            self.expert[indices[owned]] = expert[owned]
+            # the last buffer-size episode lengths are kept for the bar
+            self.shared_epi_lens[self.header[self.NUM_EPI_LENS] % self.args.buffer_size] = epi_len
+            self.header[self.NUM_EPI_LENS] += 1
+
+    @property
+    def num_in_buffer(self):
+        return int(self.header[self.NUM_IN_BUFFER]) if getattr(self, 'header', None) is not None else 0
+
+    @num_in_buffer.setter
+    def num_in_buffer(self, value):
+        pass  # derived from the shared header
+
+    def get_bar(self):
+        num_epi_lens = min(int(self.header[self.NUM_EPI_LENS]), self.args.buffer_size)
+        epi_lens = np.sort(self.shared_epi_lens[:num_epi_lens])
+        idx = int(num_epi_lens * self.args.expert_ratio)
+        return max(epi_lens[-1 - idx], self.args.expert_bar)
+
+    def can_sample_guide(self, batch_size):
+        if self.header[self.NUM_EPI_LENS] == 0:
+            return False
+        return np.count_nonzero(self.expert >= self.get_bar()) >= batch_size
+
+    def sample_guide_data(self, batch_size):
+        candidates = np.flatnonzero(self.expert >= self.get_bar())
+        indices = candidates[np.random.randint(len(candidates), size=batch_size)]
+        return {'obs': self._take(self.obs, indices),
+                'guide_action': self._take(self.guide_action, indices)}
+
+    def can_sample(self, batch_size):
+        return batch_size <= np.count_nonzero(self.valid)
+
+    def stats(self):
+        stats = super(SharedSPCBuffer, self).stats()
+        num_episodes = int(self.header[self.NUM_EPI_LENS])
+        stats.update(num_valid=int(np.count_nonzero(self.valid)), num_episodes=num_episodes,
+                     expert_candidates=int(np.count_nonzero(self.expert >= self.get_bar())) if num_episodes > 0 else 0)
+        return stats
+
+    def sample(self, batch_size, fields=None):
+        valid_starts = np.flatnonzero(self.valid)
+        assert batch_size <= len(valid_starts)
+        indices = valid_starts[np.random.choice(len(valid_starts), batch_size, replace=False)]
+        return self._encode_sample(indices, fields)
+
+    def load(self, path):
+        pass  # shared replay buffers are not persisted
 
     def save(self, path):
-        with open(os.path.join(path, 'spc_buffer.pkl'), 'wb') as f:
-            pickle.dump(self.__dict__, f)
+        pass
+
+
+class BatchPrefetcher(object):
+    """Runs `sample_fn` on worker threads ahead of the trainer and copies each
+    batch into a pool of reusable (pinned, when CUDA is available) tensors.
+
+    The replay buffer must not be written while a round started by `start` is
+    being consumed. A batch returned by `next` stays valid until the next call.
+    """
+    def __init__(self, sample_fn, depth=2, num_workers=2):
+        self.sample_fn = sample_fn
+        self.depth = depth
+        self.executor = ThreadPoolExecutor(max_workers=num_workers)
+        # one slot per batch in flight plus the one held by the trainer
+        self.free_slots = queue.Queue()
+        for _ in range(depth + 1):
+            self.free_slots.put(dict())
+        self.pending = collections.deque()
+        self.remaining = 0
+        self.current = None
+
+    def start(self, num_batches):
+        self.remaining = num_batches
+        while self.remaining > 0 and len(self.pending) < self.depth:
+            self._submit()
+
+    def next(self):
+        if self.current is not None:
+            self.free_slots.put(self.current)
+            self.current = None
+        if len(self.pending) == 0:
+            self.start(1)
+        self.current = self.pending.popleft().result()
+        if self.remaining > 0:
+            self._submit()
+        return dict(self.current)
+
+    def _submit(self):
+        self.remaining -= 1
+        self.pending.append(self.executor.submit(self._produce))
+
+    def _produce(self):
+        data_dict = self.sample_fn()
+        slot = self.free_slots.get()
+        for key, value in data_dict.items():
+            value = torch.from_numpy(value)
+            if key not in slot or slot[key].size() != value.size() or slot[key].dtype != value.dtype:
+                slot[key] = torch.empty(value.size(), dtype=value.dtype)
+                if torch.cuda.is_available():
+                    slot[key] = slot[key].pin_memory()
+            slot[key].copy_(value)
+        return slot
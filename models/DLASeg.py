@@ -64,10 +64,12 @@ class DLASeg(nn.Module):
         else:
             return xx
 
-    def infer(self, x):
+    def infer(self, x, with_log=True):
         x = self.dla_up(x)
         x = self.fc(x)
         x = self.up(x)
+        if not with_log:
+            return self.softmax(x), None
         y = self.logsoftmax(x)
         x = self.softmax(x)
         return x, y
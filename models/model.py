@@ -24,27 +24,43 @@ class ConvLSTMNet(nn.Module):
         self.off_layer = end_layer(args, args.classes, 2)
         self.speed_layer = end_layer(args, args.classes*args.frame_history_len, 1)
 
-    def forward(self, x, action, with_encode=False, hidden=None, cell=None, training=True, action_var=None):
+    def forward(self, x, action, with_encode=False, hidden=None, cell=None, training=True, action_var=None, encodings=None, heads=None):
+        # `heads` limits the outputs to the listed prediction heads and skips the seg_pred log-softmax, e.g. for planning
         output_dict = dict()
         if not with_encode:
-            x, hidden, output_dict['seg_current'] = self.get_feature(x)
+            x, hidden, seg_current = self.get_feature(x, encodings=encodings)
             if torch.cuda.is_available():
                 action_var = action_var.cuda()
+            num_candidates = action.size(0)
+            if hidden.size(0) != num_candidates:
+                # a single encoded history is shared by all candidate action sequences
+                x = [[feature.expand(num_candidates, *feature.size()[1:]) for feature in levels] for levels in x]
+                hidden = hidden.expand(num_candidates, *hidden.size()[1:])
+                seg_current = seg_current.expand(num_candidates, *seg_current.size()[1:])
+                action_var = action_var.expand(num_candidates, *action_var.size()[1:])
             x = tile_first(x, action_var)
+            if heads is None:  # only read alongside seg_pred
+                output_dict['seg_current'] = seg_current
 
         x[-1] = tile(x[-1], action)
         hx = self.feature_map_predictor(x)
-        rx, output_dict['seg_pred'] = self.dlaseg.infer(hx)
+        rx, seg_pred = self.dlaseg.infer(hx, with_log=heads is None)
+        if seg_pred is not None:
+            output_dict['seg_pred'] = seg_pred
         nx_feature_enc = x[1:] + [hx]
         hidden = torch.cat([hidden[:, self.args.classes:, :, :], rx], dim=1)
 
-        output_dict['coll_prob'] = self.coll_layer(rx.detach())
-        output_dict['offroad_prob'] = self.off_layer(rx.detach())
-        output_dict['speed'] = self.speed_layer(hidden.detach())
+        if heads is None or 'coll_prob' in heads:
+            output_dict['coll_prob'] = self.coll_layer(rx.detach())
+        if heads is None or 'offroad_prob' in heads:
+            output_dict['offroad_prob'] = self.off_layer(rx.detach())
+        if heads is None or 'speed' in heads:
+            output_dict['speed'] = self.speed_layer(hidden.detach())
 
         return output_dict, nx_feature_enc, hidden, None
 
-    def get_feature(self, x, train=True):
+    def get_feature(self, x, train=True, encodings=None):
+        # `encodings` holds precomputed dlaseg outputs (xx, rx, y) per frame, e.g. from the planner's feature cache
         batch_size, frame_history_len, height, width = x.size()
         frame_history_len = int(frame_history_len / 3)
         res = []
@@ -52,7 +68,7 @@ class ConvLSTMNet(nn.Module):
 
         if train:
             for i in range(frame_history_len):
-                xx, rx, y = self.dlaseg(x[:, i*3:(i+1)*3, :, :])
+                xx, rx, y = encodings[i] if encodings is not None else self.dlaseg(x[:, i*3:(i+1)*3, :, :])
                 res.append(xx)
                 hidden.append(rx)
             hidden = torch.cat(hidden, dim=1)
@@ -93,14 +109,14 @@ class ConvLSTMMulti(nn.Module):
         return res, hidden
 
     def get_p(self, x):
-        x, _ = self.conv_lstm.dlaseg.infer(x)
+        x, _ = self.conv_lstm.dlaseg.infer(x, with_log=False)
         return self.conv_lstm.guide_layer(x)
 
     def one_step(self, x, action, hidden):
         output_dict, nx_feature_enc, hidden, _ = self.conv_lstm(x, action, with_encode=True, hidden=hidden)
         return output_dict, nx_feature_enc, hidden
 
-    def forward(self, imgs, actions=None, hidden=None, cell=None, get_feature=False, training=True, function='', action_var=None, next_obs=False):
+    def forward(self, imgs, actions=None, hidden=None, cell=None, get_feature=False, training=True, function='', action_var=None, next_obs=False, encodings=None, heads=None):
         if function == 'guide_action':
             return self.guide_action(imgs)
         elif function == 'extract_feature':
@@ -113,16 +129,17 @@ class ConvLSTMMulti(nn.Module):
         if get_feature:
             return self.get_feature(imgs, next_obs=next_obs)
         batch_size, num_step, c, w, h = int(imgs.size()[0]), int(imgs.size()[1]), int(imgs.size()[-3]), int(imgs.size()[-2]), int(imgs.size()[-1])
-        output_dict, pred, hidden, cell = self.conv_lstm(imgs[:, 0, :, :, :].squeeze(1), actions[:, 0, :].squeeze(1), hidden=hidden, cell=cell, training=training, action_var=action_var)
+        output_dict, pred, hidden, cell = self.conv_lstm(imgs[:, 0, :, :, :].squeeze(1), actions[:, 0, :].squeeze(1), hidden=hidden, cell=cell, training=training, action_var=action_var, encodings=encodings, heads=heads)
 
         # create dictionary to store outputs
         final_dict = dict()
         for key in output_dict.keys():
             final_dict[key] = [output_dict[key]]
-        final_dict['seg_pred'] = [output_dict['seg_current'], output_dict['seg_pred']]
+        if 'seg_pred' in output_dict:
+            final_dict['seg_pred'] = [output_dict['seg_current'], output_dict['seg_pred']]
 
         for i in range(1, self.args.pred_step):
-            output_dict, pred, hidden, cell = self.conv_lstm(pred, actions[:, i, :], with_encode=True, hidden=hidden, cell=cell, training=training, action_var=None)
+            output_dict, pred, hidden, cell = self.conv_lstm(pred, actions[:, i, :], with_encode=True, hidden=hidden, cell=cell, training=training, action_var=None, heads=heads)
             for key in output_dict.keys():
                 final_dict[key].append(output_dict[key])
 
@@ -0,0 +1,278 @@
+from __future__ import division, print_function
+import argparse
+import socket
+import socketserver
+import struct
+import threading
+import numpy as np
+import torch
+from torch.autograd import Variable
+from args import init_parser, post_processing
+from memory import SPCBuffer
+
+# request ops; every reply is sent with OK or ERROR
+SAMPLE, SAMPLE_GUIDE, CAN_SAMPLE, CAN_SAMPLE_GUIDE, STORE, STORE_EXPERT, UPDATE_PRIORITIES, OK, ERROR = range(9)
+
+# frame header: op, payload length
+HEADER = struct.Struct('!BQ')
+# per-array header: name length, dtype length, ndim
+ARRAY_HEADER = struct.Struct('!HBB')
+
+
+def pack_arrays(arrays):
+    # name, dtype string, shape and raw bytes of every array, back to back
+    parts = []
+    for name, array in arrays.items():
+        array = np.asarray(array)
+        name, dtype = name.encode(), array.dtype.str.encode()
+        parts.append(ARRAY_HEADER.pack(len(name), len(dtype), array.ndim))
+        parts.append(name + dtype + struct.pack('!%dQ' % array.ndim, *array.shape))
+        parts.append(array.tobytes())
+    return b''.join(parts)
+
+
+def unpack_arrays(payload):
+    arrays, offset = dict(), 0
+    view = memoryview(payload)
+    while offset < len(payload):
+        name_len, dtype_len, ndim = ARRAY_HEADER.unpack_from(payload, offset)
+        offset += ARRAY_HEADER.size
+        name = bytes(view[offset:offset + name_len]).decode()
+        offset += name_len
+        dtype = np.dtype(bytes(view[offset:offset + dtype_len]).decode())
+        offset += dtype_len
+        shape = struct.unpack_from('!%dQ' % ndim, payload, offset)
+        offset += 8 * ndim
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        arrays[name] = np.frombuffer(payload, dtype=dtype, count=int(np.prod(shape)), offset=offset).reshape(shape)
+        offset += nbytes
+    return arrays
+
+
+def recv_exact(sock, size):
+    data = bytearray(size)
+    view = memoryview(data)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:], size - received)
+        if n == 0:
+            raise ConnectionError('replay connection closed')
+        received += n
+    return data
+
+
+def send_frame(sock, op, arrays):
+    payload = pack_arrays(arrays)
+    sock.sendall(HEADER.pack(op, len(payload)) + payload)
+
+
+def recv_frame(sock):
+    op, size = HEADER.unpack(recv_exact(sock, HEADER.size))
+    return op, unpack_arrays(recv_exact(sock, size))
+
+
+def parse_address(address):
+    # 'unix:/path/to/socket' or 'host:port'
+    if address.startswith('unix:'):
+        return socket.AF_UNIX, address[len('unix:'):]
+    host, port = address.rsplit(':', 1)
+    return socket.AF_INET, (host, int(port))
+
+
+class ReplayHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                op, request = recv_frame(self.request)
+            except ConnectionError:
+                return
+            try:
+                with self.server.buffer_lock:
+                    reply = self.server.dispatch(op, request)
+                send_frame(self.request, OK, reply)
+            except Exception as e:
+                send_frame(self.request, ERROR, {'message': np.array(repr(e))})
+
+
+class ReplayTCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class ReplayUnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class ReplayServer(object):
+    """Serves an SPCBuffer to RemoteSPCBuffer clients over a TCP or Unix socket."""
+    def __init__(self, spc_buffer, address):
+        self.spc_buffer = spc_buffer
+        family, bind_address = parse_address(address)
+        server_cls = ReplayUnixServer if family == socket.AF_UNIX else ReplayTCPServer
+        self.server = server_cls(bind_address, ReplayHandler)
+        self.server.buffer_lock = threading.Lock()  # SPCBuffer is not thread-safe
+        self.server.dispatch = self.dispatch
+        self.thread = None
+
+    @property
+    def address(self):
+        if isinstance(self.server.server_address, tuple):
+            return '%s:%d' % self.server.server_address[:2]
+        return 'unix:' + self.server.server_address
+
+    def dispatch(self, op, request):
+        buf = self.spc_buffer
+        if op == SAMPLE:
+            fields = list(request['fields']) if 'fields' in request else None
+            return buf.sample(int(request['batch_size']), fields)
+        if op == SAMPLE_GUIDE:
+            return buf.sample_guide_data(int(request['batch_size']))
+        if op == CAN_SAMPLE:
+            return {'ok': np.array(buf.can_sample(int(request['batch_size'])))}
+        if op == CAN_SAMPLE_GUIDE:
+            return {'ok': np.array(buf.can_sample_guide(int(request['batch_size'])))}
+        if op == STORE:
+            # bulk insert of complete (frame, action) rows; returns the slot of every frame
+            slots = np.empty([len(request['obs'])], dtype=np.int64)
+            for i in range(len(slots)):
+                buf.store_frame(request['obs'][i], request['collision'][i], request['offroad'][i], request['speed'][i], request['seg'][i])
+                buf.store_action(request['guide_action'][i], request['action'][i], request['done'][i])
+                slots[i] = buf.last_idx
+            return {'slots': slots}
+        if op == STORE_EXPERT:
+            buf.store_expert(request['indices'], request['expert'], int(request['epi_len']))
+            return {}
+        if op == UPDATE_PRIORITIES:
+            buf.update_priorities(request['indices'], request['losses'])
+            return {}
+        raise ValueError('unknown replay op %d' % op)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class RemoteSPCBuffer(object):
+    """Client with the SPCBuffer interface used by BufferManager and train_model.
+
+    Frames are queued locally and sent in bulk, so `last_idx` is a client-side sequence number
+    that store_expert translates to the slots the server reported."""
+    def __init__(self, args, address):
+        self.args = args
+        self.address = address
+        self.obs = None  # no local fields
+        family, connect_address = parse_address(address)
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.connect(connect_address)
+        if family == socket.AF_INET:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.lock = threading.Lock()  # the prefetcher samples from several threads
+
+        self.last_idx = -1
+        self.pending = []
+        self.slots = dict()  # client sequence number -> server slot, until the episode is labelled
+
+    def call(self, op, arrays):
+        with self.lock:
+            send_frame(self.sock, op, arrays)
+            status, reply = recv_frame(self.sock)
+        if status == ERROR:
+            raise RuntimeError('replay server: %s' % reply['message'])
+        return reply
+
+    def can_sample(self, batch_size):
+        return bool(self.call(CAN_SAMPLE, {'batch_size': np.array(batch_size)})['ok'])
+
+    def can_sample_guide(self, batch_size):
+        return bool(self.call(CAN_SAMPLE_GUIDE, {'batch_size': np.array(batch_size)})['ok'])
+
+    def sample(self, batch_size, fields=None):
+        request = {'batch_size': np.array(batch_size)}
+        if fields is not None:
+            request['fields'] = np.array(fields)
+        return self.call(SAMPLE, request)
+
+    def sample_guide_data(self, batch_size):
+        return self.call(SAMPLE_GUIDE, {'batch_size': np.array(batch_size)})
+
+    def sample_guide(self, batch_size):
+        data_dict = self.sample_guide_data(batch_size)
+        obs = Variable(torch.from_numpy(data_dict['obs']).float() / 255.0, requires_grad=False)
+        guide_action = Variable(torch.from_numpy(data_dict['guide_action']), requires_grad=False).long()
+
+        if torch.cuda.is_available():
+            obs = obs.cuda()
+            guide_action = guide_action.cuda()
+        return obs, guide_action
+
+    def record_rejection(self, guide=False):
+        pass  # buffer stats are only logged for local buffers
+
+    def update_priorities(self, indices, losses):
+        self.call(UPDATE_PRIORITIES, {'indices': np.asarray(indices), 'losses': np.asarray(losses)})
+
+    def store_frame(self, obs, collision, offroad, speed, seg):
+        self.last_idx += 1
+        self.pending.append({'obs': obs, 'collision': int(collision), 'offroad': int(offroad), 'speed': speed, 'seg': seg})
+
+    def store_action(self, guide_action, action, done):
+        self.pending[-1].update(guide_action=guide_action, action=action, done=int(done))
+        if done or len(self.pending) >= self.args.replay_store_batch:
+            self.flush()
+
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+        rows = self.pending
+        request = dict((key, np.stack([np.asarray(row[key]) for row in rows])) for key in rows[0])
+        slots = self.call(STORE, request)['slots']
+        first = self.last_idx - len(rows) + 1
+        self.slots.update(zip(range(first, first + len(rows)), slots))
+        self.pending = []
+
+    def store_expert(self, indices, expert, epi_len):
+        self.flush()
+        indices = np.asarray(indices)
+        slots = np.array([self.slots[i] for i in indices], dtype=np.int64)
+        if len(indices) > 0:
+            last = int(indices.max())
+            self.slots = dict((i, slot) for i, slot in self.slots.items() if i > last)
+        self.call(STORE_EXPERT, {'indices': slots, 'expert': np.broadcast_to(np.asarray(expert, dtype=np.float32), slots.shape),
+                                 'epi_len': np.array(epi_len)})
+
+    def load(self, path):
+        pass  # the server owns the buffer
+
+    def save(self, path):
+        pass
+
+    def close(self):
+        self.flush()
+        self.sock.close()
+
+
+def start_loopback(args):
+    # in-process server on an ephemeral port, e.g. for tests and single-machine runs
+    server = ReplayServer(SPCBuffer(args), '127.0.0.1:0').start()
+    return server, RemoteSPCBuffer(args, server.address)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='SPC replay server')
+    init_parser(parser)  # See `args.py` for default arguments
+    args = post_processing(parser.parse_args())
+    spc_buffer = SPCBuffer(args)
+    if args.resume:
+        spc_buffer.load(args.save_path)
+    server = ReplayServer(spc_buffer, args.replay_address)
+    print('Serving replay buffer on %s' % server.address)
+    server.serve_forever()
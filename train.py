@@ -1,6 +1,8 @@
 from __future__ import division, print_function
 from manager import BufferManager, ActionSampleManager
-from utils import generate_guide_grid, train_model, train_guide_action, log_frame, color_text, record_screen
+from memory import BatchPrefetcher
+from dataset import OfflineBuffer
+from utils import generate_guide_grid, train_model, train_guide_action, get_sample_fields, log_frame, color_text, record_screen
 from models import init_models
 import os
 import sys
@@ -13,6 +15,57 @@ import multiprocessing as _mp
 mp = _mp.get_context('spawn')
 
 
+def save_checkpoint(args, train_net, optimizer, epoch, step):
+    print(color_text('Saving models ...', 'green'))
+    torch.save(getattr(train_net, 'module', train_net).state_dict(),  # unwrap DataParallel
+               os.path.join(args.save_path, 'model', 'pred_model_%09d.pt' % step))
+    torch.save(optimizer.state_dict(),
+               os.path.join(args.save_path, 'optimizer', 'optimizer.pt'))
+    with open(os.path.join(args.save_path, 'epoch.pkl'), 'wb') as f:
+        pkl.dump(epoch, f)
+    print(color_text('Model saved successfully!', 'green'))
+
+
+def train_offline(args, max_steps=40000000):
+    # train on episodes exported with --export-episodes; one step is one optimizer update
+    guides = generate_guide_grid(args.bin_divide)
+    train_net, net, optimizer, epoch, exploration, num_steps = init_models(args)
+
+    spc_buffer = OfflineBuffer(args, args.offline)
+    assert spc_buffer.can_sample(args.batch_size), 'not enough recorded frames for a batch'
+    fields = get_sample_fields(args)
+    depth, workers = max(args.prefetch_batches, 2), max(args.prefetch_workers, 1)
+    prefetcher = BatchPrefetcher(lambda: spc_buffer.sample(args.batch_size, fields), depth, workers)
+    if args.use_guidance and spc_buffer.can_sample_guide(args.batch_size):
+        guide_prefetcher = BatchPrefetcher(lambda: spc_buffer.sample_guide_data(args.batch_size), depth, workers)
+    else:
+        guide_prefetcher = None
+    print('Start offline training on {} frames from {} episodes...'.format(spc_buffer.num_in_buffer, len(spc_buffer.epi_lens)))
+
+    while epoch < max_steps:
+        prefetcher.start(args.num_train_steps)
+        if guide_prefetcher is not None:
+            guide_prefetcher.start(args.num_train_steps)
+        for ep in range(args.num_train_steps):
+            optimizer.zero_grad()
+            loss = train_model(args=args,
+                               net=train_net,
+                               spc_buffer=spc_buffer,
+                               target=prefetcher.next())
+            if guide_prefetcher is not None:
+                loss += train_guide_action(args=args,
+                                           net=train_net,
+                                           spc_buffer=spc_buffer,
+                                           guides=guides,
+                                           batch=guide_prefetcher.next())
+            print('loss = %0.4f\n' % loss.data.cpu().numpy())
+            loss.backward()
+            optimizer.step()
+            epoch += 1
+            if epoch % args.save_freq == 0:
+                save_checkpoint(args, train_net, optimizer, epoch, epoch)
+
+
 def train_policy(args, env, max_steps=40000000):
     guides = generate_guide_grid(args.bin_divide)
     train_net, net, optimizer, epoch, exploration, num_steps = init_models(args)
@@ -21,6 +74,15 @@ def train_policy(args, env, max_steps=40000000):
     action_manager = ActionSampleManager(args, guides)
     action_var = Variable(torch.from_numpy(np.array([-1.0, 0.0])).repeat(1, args.frame_history_len - 1, 1), requires_grad=False).float()
 
+    # sample training batches ahead of the optimizer on worker threads
+    if args.prefetch_batches > 0:
+        spc_buffer = buffer_manager.spc_buffer
+        fields = get_sample_fields(args)
+        prefetcher = BatchPrefetcher(lambda: spc_buffer.sample(args.batch_size, fields), args.prefetch_batches, args.prefetch_workers)
+        guide_prefetcher = BatchPrefetcher(lambda: spc_buffer.sample_guide_data(args.batch_size), args.prefetch_batches, args.prefetch_workers)
+    else:
+        prefetcher, guide_prefetcher = None, None
+
     # prepare video recording
     if args.recording:
         video_folder = os.path.join(args.video_folder, "%d" % num_steps)
@@ -54,6 +116,7 @@ def train_policy(args, env, max_steps=40000000):
                                                             action_var=action_var,
                                                             exploration=exploration,
                                                             step=step,
+                                                            feature_cache=buffer_manager.feature_cache,
                                                             explore=num_episode % 2)
         obs, reward, done, info = env.step(action)
         print("action [{0:.2f}, {1:.2f}]".format(action[0], action[1]) + " " +
@@ -81,35 +144,45 @@ def train_policy(args, env, max_steps=40000000):
                 del p
 
         # train SPN
-        if buffer_manager.spc_buffer.can_sample(args.batch_size) and ((not args.sync and done) or (args.sync and step % args.learning_freq == 0)):
+        # the learning-step check goes first: with a remote buffer can_sample is a round trip to the server
+        learning_step = (not args.sync and done) or (args.sync and step % args.learning_freq == 0)
+        can_train = learning_step and buffer_manager.spc_buffer.can_sample(args.batch_size)
+        if learning_step and not can_train:
+            buffer_manager.spc_buffer.record_rejection()
+        if can_train:
             # train model
+            can_guide = args.use_guidance and buffer_manager.spc_buffer.can_sample_guide(args.batch_size)
+            if args.use_guidance and not can_guide:
+                buffer_manager.spc_buffer.record_rejection(guide=True)
+            use_guide_prefetcher = False
+            if prefetcher is not None:
+                prefetcher.start(args.num_train_steps)
+                if can_guide:
+                    use_guide_prefetcher = True
+                    guide_prefetcher.start(args.num_train_steps)
             for ep in range(args.num_train_steps):
                 optimizer.zero_grad()
                 loss = train_model(args=args,
                                    net=train_net,
-                                   spc_buffer=buffer_manager.spc_buffer)
+                                   spc_buffer=buffer_manager.spc_buffer,
+                                   target=prefetcher.next() if prefetcher is not None else None)
                 if args.use_guidance:
                     loss += train_guide_action(args=args,
                                                net=train_net,
                                                spc_buffer=buffer_manager.spc_buffer,
-                                               guides=guides)
+                                               guides=guides,
+                                               batch=guide_prefetcher.next() if use_guide_prefetcher else None)
                 print('loss = %0.4f\n' % loss.data.cpu().numpy())
                 loss.backward()
                 optimizer.step()
                 epoch += 1
             net.load_state_dict(train_net.state_dict())
+            buffer_manager.feature_cache.clear()  # cached encodings came from the old weights
 
             # save model
             if epoch % args.save_freq == 0:
-                print(color_text('Saving models ...', 'green'))
-                torch.save(train_net.module.state_dict(),
-                           os.path.join(args.save_path, 'model', 'pred_model_%09d.pt' % step))
-                torch.save(optimizer.state_dict(),
-                           os.path.join(args.save_path, 'optimizer', 'optimizer.pt'))
-                with open(os.path.join(args.save_path, 'epoch.pkl'), 'wb') as f:
-                    pkl.dump(epoch, f)
+                save_checkpoint(args, train_net, optimizer, epoch, step)
                 buffer_manager.save_spc_buffer()
-                print(color_text('Model saved successfully!', 'green'))
 
         if done:
             # reset video recording
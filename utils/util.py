@@ -80,10 +80,18 @@ def color_text(text, color):
     return prefix + text + '\033[0m'
 
 
-def train_guide_action(args, net, spc_buffer, guides):
+def train_guide_action(args, net, spc_buffer, guides, batch=None):
     assert args.use_guidance
-    if spc_buffer.can_sample_guide(args.batch_size):
-        obs, guide_action = spc_buffer.sample_guide(args.batch_size)
+    if batch is not None or spc_buffer.can_sample_guide(args.batch_size):
+        if batch is None:
+            obs, guide_action = spc_buffer.sample_guide(args.batch_size)
+        else:  # prefetched by BatchPrefetcher
+            obs, guide_action = batch['obs'], batch['guide_action']
+            if torch.cuda.is_available():
+                obs = obs.cuda(non_blocking=True)
+                guide_action = guide_action.cuda(non_blocking=True)
+            obs = Variable(obs.float() / 255.0, requires_grad=False)
+            guide_action = Variable(guide_action, requires_grad=False).long()
         q = net(obs, function='guide_action')
         loss = nn.CrossEntropyLoss()(q, guide_action)
         if args.verbose:
@@ -198,29 +206,55 @@ def write_log(args, file, func, output, target):
         f.write('\n')
 
 
-def train_model(args, net, spc_buffer):
-    target = spc_buffer.sample(args.batch_size)
+def get_sample_fields(args):
+    # replay fields that train_model reads under the enabled losses
+    if args.verbose:
+        return None  # visualize reads every field
+    fields = {'obs_strip', 'act_batch', 'prev_action'}
+    if args.use_collision:
+        fields.add('coll_batch')
+    if args.use_offroad:
+        fields.add('off_batch')
+    if args.use_speed:
+        fields.add('sp_batch')
+    if args.no_supervision:
+        fields.add('nx_obs')
+    else:
+        fields.add('seg_batch')
+    return fields
 
+
+def train_model(args, net, spc_buffer, target=None):
+    if target is None:
+        target = spc_buffer.sample(args.batch_size, fields=get_sample_fields(args))
+        for key in target.keys():
+            target[key] = torch.from_numpy(target[key])
+
+    # buffer positions of a prioritized batch, used to update its priorities below
+    indices = target.pop('idx_batch').numpy() if 'idx_batch' in target else None
+
+    # transfer in the stored dtypes and convert on the device
     for key in target.keys():
-        target[key] = Variable(torch.from_numpy(target[key]).float(), requires_grad=False)
+        if torch.cuda.is_available():
+            target[key] = target[key].cuda(non_blocking=True)
+        target[key] = Variable(target[key].float(), requires_grad=False)
 
-    target['obs_batch'] = target['obs_batch'] / 255.0
+    target['obs_strip'] = target['obs_strip'] / 255.0
+    obs_batch = stack_frames(target['obs_strip'], args.frame_history_len, num_windows=1)
 
     if args.no_supervision:
-        target['nx_obs_batch'] = target['nx_obs_batch'] / 255.0
+        nx_obs_batch = stack_frames(target['obs_strip'], args.frame_history_len, start=1, num_windows=args.pred_step)
         with torch.no_grad():
-            nximg_enc = net(target['nx_obs_batch'], get_feature=True, next_obs=True).detach()
+            nximg_enc = net(nx_obs_batch, get_feature=True, next_obs=True).detach()
         nximg_enc = nximg_enc[:, :, -args.classes:, :, :]
     else:
         target['seg_batch'] = target['seg_batch'].long()
 
-    if torch.cuda.is_available():
-        for key in target.keys():
-            target[key] = target[key].cuda()
-
-    output = net(target['obs_batch'], target['act_batch'], action_var=target['prev_action'])
+    output = net(obs_batch, target['act_batch'], action_var=target['prev_action'])
 
     loss = 0
+    sample_weight = target.get('is_weight')  # importance-sampling weights of a prioritized batch
+    sample_loss = 0
 
     weight = (args.time_decay ** np.arange(args.pred_step)).reshape((1, args.pred_step, 1))
     weight = Variable(torch.from_numpy(weight).float().cuda(), requires_grad=False).repeat(args.batch_size, 1, 1)
@@ -240,7 +274,10 @@ def train_model(args, net, spc_buffer):
                     f.write('%0.3f ' % colls[i])
                 f.write('\n')
 
-        coll_ls = nn.CrossEntropyLoss()(output['coll_prob'].view(-1, 2), target['coll_batch'].view(-1).long())
+        coll_ls = nn.CrossEntropyLoss(reduction='none')(output['coll_prob'].view(-1, 2), target['coll_batch'].view(-1).long())
+        coll_ls = coll_ls.view(args.batch_size, -1).mean(1)
+        sample_loss += coll_ls.detach()
+        coll_ls = weighted_mean(coll_ls, sample_weight)
         loss += coll_ls
         print('Collision loss:', coll_ls.data.cpu().numpy())
 
@@ -259,12 +296,18 @@ def train_model(args, net, spc_buffer):
                     f.write('%0.3f ' % offs[i])
                 f.write('\n')
 
-        offroad_ls = nn.CrossEntropyLoss()(output['offroad_prob'].view(-1, 2), target['off_batch'].view(-1).long())
+        offroad_ls = nn.CrossEntropyLoss(reduction='none')(output['offroad_prob'].view(-1, 2), target['off_batch'].view(-1).long())
+        offroad_ls = offroad_ls.view(args.batch_size, -1).mean(1)
+        sample_loss += offroad_ls.detach()
+        offroad_ls = weighted_mean(offroad_ls, sample_weight)
         loss += offroad_ls
         print('Offroad loss:', offroad_ls.data.cpu().numpy())
 
     if args.use_speed:
-        speed_loss = torch.sqrt(nn.MSELoss()(output['speed'], target['sp_batch'][:, 1:].unsqueeze(dim=2)))
+        speed_loss = nn.MSELoss(reduction='none')(output['speed'], target['sp_batch'][:, 1:].unsqueeze(dim=2))
+        speed_loss = speed_loss.view(args.batch_size, -1).mean(1)
+        sample_loss += 0.01 * torch.sqrt(speed_loss.detach())
+        speed_loss = torch.sqrt(weighted_mean(speed_loss, sample_weight))
         loss += 0.01 * speed_loss
         print('speed ls', speed_loss.data.cpu().numpy())
 
@@ -272,11 +315,15 @@ def train_model(args, net, spc_buffer):
         pred = output['seg_pred'][:, 1:, ...].contiguous().view(args.batch_size * args.pred_step, args.classes * args.frame_height * args.frame_width)
         nximg_enc = nximg_enc.contiguous().view(args.batch_size * args.pred_step, args.classes * args.frame_height * args.frame_width)
         pred_ls = torch.sum(nn.KLDivLoss(reduce=False)(pred, nximg_enc), dim=-1)
-        pred_ls = torch.sum(pred_ls.contiguous().view(args.batch_size, args.pred_step, 1) * weight) / args.batch_size / args.frame_height / args.frame_width
+        pred_ls = torch.sum(pred_ls.contiguous().view(args.batch_size, args.pred_step, 1) * weight, dim=(1, 2)) / args.frame_height / args.frame_width
+        sample_loss += pred_ls.detach()
+        pred_ls = weighted_mean(pred_ls, sample_weight)
     else:
         output['seg_pred'] = output['seg_pred'].view(args.batch_size * (args.pred_step + 1), args.classes, 256, 256)
         target['seg_batch'] = target['seg_batch'].view(args.batch_size * (args.pred_step + 1), 256, 256)
-        pred_ls = nn.NLLLoss()(output['seg_pred'], target['seg_batch'])
+        pred_ls = nn.NLLLoss(reduction='none')(output['seg_pred'], target['seg_batch']).view(args.batch_size, -1).mean(1)
+        sample_loss += pred_ls.detach()
+        pred_ls = weighted_mean(pred_ls, sample_weight)
         seg_np = torch.argmax(output['seg_pred'].view(args.batch_size, args.pred_step + 1, args.classes, 256, 256), dim=2).data.cpu().numpy()
         target_np = target['seg_batch'].view(args.batch_size, args.pred_step + 1, 256, 256).data.cpu().numpy()
 
@@ -289,11 +336,21 @@ def train_model(args, net, spc_buffer):
     print('Segmentation loss:', pred_ls.data.cpu().numpy())  # nan here!
     loss += pred_ls
 
+    if indices is not None:
+        spc_buffer.update_priorities(indices, from_variable_to_numpy(sample_loss))
+
     if args.verbose:
         visualize(args, target, output)
     return loss
 
 
+def weighted_mean(x, sample_weight=None):
+    # mean of per-sample losses, weighted by importance-sampling weights when given
+    if sample_weight is None:
+        return x.mean()
+    return (x * sample_weight).mean()
+
+
 def draw_from_pred_torcs(pred):
     illustration = np.zeros((256, 256, 3)).astype(np.uint8)
     illustration[:, :, 0] = 255
@@ -369,7 +426,7 @@ def visualize(args, target, output):
         os.mkdir('visualize')
 
     batch_id = np.random.randint(args.batch_size)
-    observation = (from_variable_to_numpy(target['obs_batch'][batch_id, :, -3:, :, :]) * 255.0).astype(np.uint8).transpose(0, 2, 3, 1)
+    observation = (from_variable_to_numpy(target['obs_strip'][batch_id, args.frame_history_len - 1:, :, :, :]) * 255.0).astype(np.uint8).transpose(0, 2, 3, 1)
     target['seg_batch'] = target['seg_batch'].view(args.batch_size, args.pred_step + 1, 256, 256)
     segmentation = from_variable_to_numpy(target['seg_batch'][batch_id])
     output['seg_pred'] = output['seg_pred'].view(args.batch_size, args.pred_step + 1, args.classes, 256, 256)
@@ -433,31 +490,88 @@ def load_model(path, net, resume=True):
     return net, epoch
 
 
-def sample_action(args, p, net, imgs, guides, action_var=None, testing=False):
-    imgs = copy.deepcopy(imgs) / 255.0
+def sample_action(args, p, net, imgs, guides, action_var=None, testing=False, feature_cache=None, warm_start=None):
+    # `warm_start` holds extra [k, pred_step, num_total_act] candidate sequences scored alongside the sampled ones
+    imgs = imgs / 255.0
     batch_size, c, w, h = int(imgs.size()[0]), int(imgs.size()[-3]), int(imgs.size()[-2]), int(imgs.size()[-1])
     imgs = imgs.view(batch_size, 1, c, w, h)
+    # the history is encoded once and broadcast to the candidates inside the model, which
+    # DataParallel would split unevenly, so the planner runs on the wrapped module
+    if isinstance(net, torch.nn.DataParallel):
+        net = net.module
+    with torch.no_grad():
+        if feature_cache is not None:
+            encodings = feature_cache.encode(net, imgs[:, 0])
+        else:
+            encodings = [net.conv_lstm.dlaseg(imgs[:, 0, i*3:(i+1)*3, :, :]) for i in range(c // 3)]
 
-    imgs = imgs.repeat(25, 1, 1, 1, 1)
-    action_var = action_var.repeat(25, 1, 1)
-
-    if args.use_guidance:
-        action = generate_action(args, p, 25, guides)
+    if args.planner == 'cem':
+        res, from_warm_start = cem_plan(args, p, net, imgs, guides, action_var, encodings, warm_start=warm_start)
     else:
-        action = guides.reshape(25, 1, 2).repeat(10, axis=1)
-    this_action0 = copy.deepcopy(action)
-    this_action = Variable(torch.from_numpy(action).cuda().float(), requires_grad=False)
+        num_sampled = args.num_candidates - (len(warm_start) if warm_start is not None else 0)
+        action = initial_candidates(args, p, guides, num_sampled)
+        if warm_start is not None:
+            action = add_warm_start(action, warm_start)
+        this_action0 = copy.deepcopy(action)
+        this_action = Variable(torch.from_numpy(action).cuda().float(), requires_grad=False)
 
-    with torch.no_grad():
-        start_time = time.time()
-        loss = get_action_loss(args, net, imgs, this_action, action_var, None, None, None).data.cpu().numpy()
-        print('Sampling takes %0.2f seconds.' % (time.time() - start_time))
+        with torch.no_grad():
+            start_time = time.time()
+            loss = get_action_loss(args, net, imgs, this_action, action_var, None, None, None, encodings=encodings).data.cpu().numpy()
+            print('Sampling takes %0.2f seconds.' % (time.time() - start_time))
 
-    idx = np.argmin(loss)
-    res = this_action0[idx, :, :]
+        idx = np.argmin(loss)
+        res = this_action0[idx, :, :]
+        from_warm_start = idx >= num_sampled
     if not testing:
         res = res[0]
-    return res
+    return res, from_warm_start
+
+
+def initial_candidates(args, p, guides, num):
+    # sampled from the guidance distribution p, or constant sequences spread evenly over the guide grid
+    if args.use_guidance:
+        return generate_action(args, p, num, guides)
+    rows = np.linspace(0, len(guides), num, endpoint=False).astype(int)
+    return guides[rows].reshape(num, 1, -1).repeat(args.pred_step, axis=1)
+
+
+def add_warm_start(action, warm_start):
+    # warm-start candidates already among the sampled ones, e.g. a shifted constant grid plan, add nothing
+    duplicate = np.all(np.isclose(warm_start[:, np.newaxis], action[np.newaxis]), axis=(2, 3)).any(axis=1)
+    return np.concatenate([action, warm_start[~duplicate]], axis=0)
+
+
+def cem_plan(args, p, net, imgs, guides, action_var, encodings, min_std=0.05, warm_start=None):
+    # cross-entropy method: refit a per-timestep Gaussian over the action sequence to the elite candidates;
+    # also returns whether the plan is one of the warm-start candidates of the first population
+    start_time = time.time()
+    num_sampled = args.cem_population - (len(warm_start) if warm_start is not None else 0)
+    action = initial_candidates(args, p, guides, num_sampled)
+    if warm_start is not None:
+        action = add_warm_start(action, warm_start)
+
+    best_action, best_loss, from_warm_start = None, np.inf, False
+    for it in range(args.cem_iters):
+        iter_start = time.time()
+        this_action = Variable(torch.from_numpy(action).cuda().float(), requires_grad=False)
+        with torch.no_grad():
+            loss = get_action_loss(args, net, imgs, this_action, action_var, None, None, None, encodings=encodings).data.cpu().numpy()
+        order = np.argsort(loss)
+        if loss[order[0]] < best_loss:
+            best_loss, best_action = loss[order[0]], action[order[0]].copy()
+            from_warm_start = it == 0 and order[0] >= num_sampled
+
+        # stop early if another iteration would overrun the latency budget
+        elapsed = time.time() - start_time
+        if args.cem_time_budget > 0 and elapsed + (time.time() - iter_start) > args.cem_time_budget:
+            break
+        if it < args.cem_iters - 1:
+            elites = action[order[:args.cem_elites]]
+            mean, std = elites.mean(axis=0), np.maximum(elites.std(axis=0), min_std)
+            action = np.clip(mean + std * np.random.randn(args.cem_population, *mean.shape), -1, 1)
+    print('CEM planning takes %0.2f seconds for %d iterations.' % (time.time() - start_time, it + 1))
+    return best_action, from_warm_start
 
 
 def from_variable_to_numpy(x):
@@ -468,6 +582,14 @@ def from_variable_to_numpy(x):
     return x
 
 
+def stack_frames(strip, frame_history_len, start=0, num_windows=1):
+    # [B, L, 3, H, W] frame strip -> [B, num_windows, 3 * frame_history_len, H, W] stacked history windows
+    batch_size, _, c, h, w = strip.size()
+    windows = strip[:, start:start + num_windows + frame_history_len - 1].unfold(1, frame_history_len, 1)
+    windows = windows.permute(0, 1, 5, 2, 3, 4).contiguous()
+    return windows.view(batch_size, num_windows, frame_history_len * c, h, w)
+
+
 def tile_single(x, action):
     batch_size, c, w, h = x.size()
     assert action.size(0) == batch_size
@@ -485,12 +607,18 @@ def tile_first(x, action):
     return x
 
 
-def get_action_loss(args, net, imgs, actions, action_var=None, target=None, hidden=None, cell=None, gpu=0):
-    batch_size = int(imgs.size()[0])
+def get_action_loss(args, net, imgs, actions, action_var=None, target=None, hidden=None, cell=None, gpu=0, encodings=None):
+    batch_size = int(actions.size()[0])
 
     weight = (args.time_decay ** np.arange(args.pred_step)).reshape((1, args.pred_step, 1))
     weight = Variable(torch.from_numpy(weight).float().cuda()).repeat(batch_size, 1, 1)
-    output = net(imgs, actions, hidden=hidden, cell=cell, training=False, action_var=action_var)
+    # only the heads the cost reads are computed
+    heads = []
+    if args.sample_with_collision:
+        heads += ['coll_prob', 'speed']
+    if args.sample_with_offroad:
+        heads += ['offroad_prob', 'speed']
+    output = net(imgs, actions, hidden=hidden, cell=cell, training=False, action_var=action_var, encodings=encodings, heads=heads)
 
     loss = 0
 